@@ -0,0 +1,185 @@
+import os
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from vector_search import top_k
+
+"""
+Inverted file (IVF) index for approximate maximum inner product search over the code embeddings.
+
+The corpus is clustered with k-means, every vector is stored in the list of its closest centroid and a query only scores
+the vectors of the nprobe lists whose centroids have the highest inner product with it.
+"""
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 16384) -> np.ndarray:
+    # Nearest centroid in euclidean distance, computed in chunks to bound the size of the distance matrix
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        distances = centroid_norms[None, :] - 2 * chunk @ centroids.T
+        assignment[start:start + chunk_size] = distances.argmin(axis=1)
+    return assignment
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        # Empty clusters are restarted on random vectors
+        n_empty = int((~non_empty).sum())
+        if n_empty > 0:
+            centroids[~non_empty] = vectors[rng.choice(len(vectors), n_empty, replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray, nprobe: int = 8):
+        self.centroids = centroids
+        # The ids of list i are list_ids[list_offsets[i]:list_offsets[i + 1]]
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+        self.vectors = None
+        # Identity of the embedding store the lists were built from
+        self.source = ""
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        n_lists: int = None,
+        n_iter: int = 20,
+        max_training_points: int = 256,
+        seed: int = 0,
+        nprobe: int = 8,
+    ) -> "IVFIndex":
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        # k-means is trained on a sample of the corpus, afterwards every vector is assigned to its list
+        rng = np.random.default_rng(seed)
+        n_training = min(len(vectors), n_lists * max_training_points)
+        training_ids = np.sort(rng.choice(len(vectors), n_training, replace=False))
+        centroids = kmeans(vectors[training_ids], n_lists, n_iter=n_iter, seed=seed)
+
+        assignment = _assign(vectors, centroids)
+        list_ids = np.argsort(assignment, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+        index = cls(centroids, list_offsets, list_ids, nprobe=nprobe)
+        index.attach(vectors)
+        return index
+
+    def attach(self, vectors: np.ndarray):
+        # The index only stores ids, scoring reads the vectors of the probed lists from the (mapped) corpus matrix
+        if len(vectors) != len(self.list_ids):
+            raise ValueError("Index was built for {} vectors, got {}".format(len(self.list_ids), len(vectors)))
+        self.vectors = vectors
+
+    def save(self, file_path: str):
+        # Written next to the target and moved into place, other workers never load a partly written index
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids, source=self.source
+            )
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str, vectors: np.ndarray = None, nprobe: int = 8) -> "IVFIndex":
+        with np.load(file_path) as data:
+            index = cls(data["centroids"], data["list_offsets"], data["list_ids"], nprobe=nprobe)
+            index.source = str(data["source"]) if "source" in data.files else ""
+        if vectors is not None:
+            index.attach(vectors)
+        return index
+
+    def candidates(self, query_vec: np.ndarray, nprobe: int = None) -> np.ndarray:
+        nprobe = self.nprobe if nprobe is None else nprobe
+        probed_lists, _ = top_k(self.centroids @ query_vec, nprobe)
+        ids = np.concatenate(
+            [self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed_lists]
+        )
+        # Sorted ids read the mapped matrix front to back
+        return np.sort(ids)
+
+    def search(self, query_vec: np.ndarray, k: int, nprobe: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        query_vec = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+        ids = self.candidates(query_vec, nprobe)
+        positions, scores = top_k(self.vectors[ids] @ query_vec, k)
+        return ids[positions], scores
+
+
+def recall_report(
+    index: IVFIndex, query_vecs: np.ndarray, k: int = 10, nprobe_values: Sequence[int] = (1, 2, 4, 8, 16, 32)
+) -> List[Dict]:
+    # Recall@k of the index against exhaustive search, together with the mean query time of both
+    exact = []
+    start = time.perf_counter()
+    for query_vec in query_vecs:
+        exact.append(set(top_k(index.vectors @ query_vec, k)[0].tolist()))
+    exhaustive_ms = 1000 * (time.perf_counter() - start) / len(query_vecs)
+
+    report = []
+    for nprobe in nprobe_values:
+        hits = 0
+        start = time.perf_counter()
+        for query_vec, expected in zip(query_vecs, exact):
+            ids, _ = index.search(query_vec, k, nprobe=nprobe)
+            hits += len(expected.intersection(ids.tolist()))
+        elapsed_ms = 1000 * (time.perf_counter() - start) / len(query_vecs)
+        report.append({
+            "nprobe": nprobe,
+            "recall@{}".format(k): hits / (k * len(query_vecs)),
+            "query_ms": elapsed_ms,
+            "exhaustive_ms": exhaustive_ms,
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from embedding_store import EmbeddingStore
+
+    parser = argparse.ArgumentParser(description="Build an IVF index for an embedding store and report its recall")
+    parser.add_argument("store_path")
+    parser.add_argument("index_path")
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--queries", default=None, help=".npy file with query embeddings, default: corpus sample")
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_path)
+    build_start = time.perf_counter()
+    ivf_index = IVFIndex.build(store.vectors, n_lists=args.n_lists)
+    ivf_index.source = store.identity
+    print("Built {} lists in {:.1f}s".format(ivf_index.n_lists, time.perf_counter() - build_start))
+    ivf_index.save(args.index_path)
+
+    if args.queries is not None:
+        queries = np.load(args.queries)
+    else:
+        query_ids = np.random.default_rng(0).choice(len(store), min(args.n_queries, len(store)), replace=False)
+        queries = np.asarray(store.vectors[np.sort(query_ids)], dtype=np.float32)
+    for row in recall_report(ivf_index, queries, k=args.k):
+        print(row)
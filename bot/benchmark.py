@@ -0,0 +1,254 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+from transformers import RobertaTokenizerFast, RobertaModel
+
+from ann_index import IVFIndex
+from code_search import RobertaCodeSearch
+from codebert_model import CodeEncoder, Model
+from embedding_builder import EmbeddingBuilder, keys_path
+from embedding_store import EmbeddingStore, model_fingerprint
+from encoder_parity import held_out_queries
+from quantization import train_quantizer
+from record_store import RecordStore
+
+"""
+End to end benchmark of the code search on a held-out jsonl corpus. The docstring of every sampled record is used as
+query and its own record is the relevant result, as in the MRR evaluation of the fine-tuning notebook.
+
+For every search mode the report contains MRR@k and recall@k, the recall of the exhaustive top-k, the p50/p95/p99
+latency and the QPS of single queries, the time to build the index of the mode, the size of the vectors or codes it
+scans and the resident memory afterwards. The recall of the exhaustive top-k compares the approximate modes even when
+the model ranks the relevant records badly, like the random model of the fixture.
+Every mode runs in a fresh process, so the resident memory of one mode does not include the pages of another. The
+embedding store itself is built once and shared by all modes.
+
+Without a model the benchmark runs on the generated fixture of benchmark_fixture.py, which works offline:
+    python benchmark.py --fixture
+"""
+
+MODES = ("exhaustive", "ann", "sq8", "pq", "int8")
+
+
+def resident_memory_mb() -> float:
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    import resource
+
+    # Peak instead of current resident memory, ru_maxrss is in kilobytes on linux and survives the exec of a spawned
+    # process, so it is only a last resort
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_embeddings(corpus_path: str, store_path: str, model_path: str, tokenizer_name: str) -> float:
+    # A fresh build, so the time includes encoding every record
+    for path in (store_path, keys_path(store_path)):
+        if os.path.exists(path):
+            os.remove(path)
+    tokenizer = RobertaTokenizerFast.from_pretrained(tokenizer_name)
+    model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=model_path))
+    encoder = CodeEncoder(tokenizer, model, model_fingerprint(model_path))
+    start = time.perf_counter()
+    EmbeddingBuilder(corpus_path, store_path).build(encoder)
+    return time.perf_counter() - start
+
+
+def build_index(mode: str, store_path: str, index_path: str, nprobe: int) -> float:
+    store = EmbeddingStore(store_path)
+    start = time.perf_counter()
+    if mode == "ann":
+        ivf_index = IVFIndex.build(store.vectors, nprobe=nprobe)
+        ivf_index.source = store.identity
+        ivf_index.save(index_path)
+    elif mode in ("sq8", "pq"):
+        quantizer = train_quantizer(mode, store.vectors)
+        # RobertaCodeSearch only reuses codes which were computed from its store
+        quantizer.source = store.identity
+        quantizer.save(index_path)
+    return time.perf_counter() - start
+
+
+def search_options(mode: str, index_path: str, nprobe: int) -> Dict:
+    if mode == "ann":
+        return {"use_ann_index": True, "ann_index_file": index_path, "nprobe": nprobe}
+    elif mode in ("sq8", "pq"):
+        return {"quantization": mode, "quantized_file": index_path}
+    elif mode == "int8":
+        return {"quantize_query_encoder": True}
+    return {}
+
+
+def evaluate(
+    code_search: RobertaCodeSearch, queries: List[str], relevant: np.ndarray, k: int
+) -> Tuple[Dict, List[List[int]]]:
+    # Returns the metrics and the result ids of every query
+    # Warm-up query, the first forward pass allocates the buffers of the model
+    code_search.find_code_for_query_topk(queries[0], k)
+    latencies = []
+    reciprocal_ranks = []
+    result_ids = []
+    start_time = time.perf_counter()
+    for query, expected in zip(queries, relevant):
+        start = time.perf_counter()
+        results = code_search.find_code_for_query_topk(query, k)
+        latencies.append(1000 * (time.perf_counter() - start))
+        result_ids.append([index for index, _, _ in results])
+        ranks = [rank for rank, (index, _, _) in enumerate(results) if index == expected]
+        reciprocal_ranks.append(1 / (ranks[0] + 1) if len(ranks) > 0 else 0.0)
+    elapsed = time.perf_counter() - start_time
+    reciprocal_ranks = np.array(reciprocal_ranks)
+    metrics = {
+        "mrr@{}".format(k): float(reciprocal_ranks.mean()),
+        # Every query has a single relevant record, so recall@k is the share of queries which found it
+        "recall@{}".format(k): float((reciprocal_ranks > 0).mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "qps": len(queries) / elapsed,
+    }
+    return metrics, result_ids
+
+
+def exhaustive_recall(result_ids: List[List[int]], exhaustive_ids: List[List[int]]) -> float:
+    # Mean share of the exhaustive top-k of a query which a mode returns as well
+    return float(np.mean([
+        len(set(ids) & set(expected)) / len(expected) if len(expected) > 0 else 1.0
+        for ids, expected in zip(result_ids, exhaustive_ids)
+    ]))
+
+
+def index_memory_mb(code_search: RobertaCodeSearch) -> float:
+    # Bytes of the structure a query scans: the codes of a quantizer, the lists of the IVF index or all float vectors
+    if code_search.quantizer is not None:
+        return code_search.quantizer.nbytes / 2 ** 20
+    if code_search.ann_index is not None:
+        ann_index = code_search.ann_index
+        return (ann_index.centroids.nbytes + ann_index.list_offsets.nbytes + ann_index.list_ids.nbytes) / 2 ** 20
+    return code_search.vecs.nbytes / 2 ** 20
+
+
+def run_mode(
+    mode: str,
+    corpus_path: str,
+    model_path: str,
+    tokenizer_name: str,
+    store_path: str,
+    index_path: str,
+    queries: List[str],
+    relevant: np.ndarray,
+    k: int,
+    nprobe: int,
+) -> Tuple[Dict, List[List[int]]]:
+    code_search = RobertaCodeSearch(
+        model_path=model_path,
+        embedding_store_file=store_path,
+        codebase_file=corpus_path,
+        query_cache_size=0,
+        tokenizer_name=tokenizer_name,
+        **search_options(mode, index_path, nprobe)
+    )
+    row = {"mode": mode, "records": len(code_search.code_records), "queries": len(queries)}
+    metrics, result_ids = evaluate(code_search, queries, relevant, k)
+    row.update(metrics)
+    row["index_mb"] = index_memory_mb(code_search)
+    row["rss_mb"] = resident_memory_mb()
+    return row, result_ids
+
+
+def run_benchmark(
+    corpus_path: str,
+    model_path: str,
+    tokenizer_name: str,
+    work_dir: str,
+    modes=MODES,
+    k: int = 10,
+    n_queries: int = 500,
+    nprobe: int = 8,
+) -> List[Dict]:
+    os.makedirs(work_dir, exist_ok=True)
+    store_path = os.path.join(work_dir, "embeddings.store")
+    embedding_build_s = build_embeddings(corpus_path, store_path, model_path, tokenizer_name)
+    queries, relevant = held_out_queries(RecordStore(corpus_path), n_queries)
+
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}, expected one of {}".format(mode, MODES))
+    report = []
+    exhaustive_ids = None
+    # The exhaustive results are the reference of every other mode, they are computed first even if not reported
+    for mode in ["exhaustive"] + [mode for mode in modes if mode != "exhaustive"]:
+        index_path = os.path.join(work_dir, "embeddings.{}.npz".format(mode))
+        index_build_s = build_index(mode, store_path, index_path, nprobe)
+        # A spawned process starts without the model, the store pages and the indexes of the previous modes
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            row, result_ids = executor.submit(
+                run_mode, mode, corpus_path, model_path, tokenizer_name, store_path, index_path, queries, relevant, k,
+                nprobe,
+            ).result()
+        if mode == "exhaustive":
+            exhaustive_ids = result_ids
+            if mode not in modes:
+                continue
+        row["exhaustive_recall@{}".format(k)] = exhaustive_recall(result_ids, exhaustive_ids)
+        row["embedding_build_s"] = embedding_build_s
+        row["index_build_s"] = index_build_s
+        report.append(row)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from benchmark_fixture import make_fixture
+
+    parser = argparse.ArgumentParser(description="Benchmark search quality, latency and memory of the search modes")
+    parser.add_argument("corpus_path", nargs="?", default=None, help="Held-out jsonl, default: the fixture corpus")
+    parser.add_argument("--model-path", default=None, help="Default: the fixture model")
+    parser.add_argument("--tokenizer", default="microsoft/codebert-base")
+    parser.add_argument("--fixture", action="store_true", help="Use the generated offline fixture model")
+    parser.add_argument("--work-dir", default="./benchmark")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--n-queries", type=int, default=500)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--output", default=None, help="Write the report as json")
+    args = parser.parse_args()
+
+    corpus, model, tokenizer_path = args.corpus_path, args.model_path, args.tokenizer
+    if args.fixture or model is None:
+        fixture = make_fixture(os.path.join(args.work_dir, "fixture"))
+        model, tokenizer_path = fixture["model_path"], fixture["tokenizer_path"]
+        corpus = corpus or fixture["corpus_path"]
+    if corpus is None:
+        parser.error("corpus_path is required with --model-path")
+
+    rows = run_benchmark(
+        corpus, model, tokenizer_path, args.work_dir, modes=args.modes, k=args.k, n_queries=args.n_queries,
+        nprobe=args.nprobe,
+    )
+    columns = list(rows[0].keys())
+    widths = [max(17, len(column)) for column in columns]
+    print(" ".join("{:>{}}".format(column, width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print(" ".join(
+            "{:>{}.4f}".format(row[column], width) if isinstance(row[column], float)
+            else "{:>{}}".format(row[column], width)
+            for column, width in zip(columns, widths)
+        ))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
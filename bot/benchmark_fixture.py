@@ -0,0 +1,146 @@
+import ast
+import gzip
+import hashlib
+import json
+import os
+import re
+import sysconfig
+from glob import glob
+from typing import Iterator, List
+
+import torch
+from tokenizers import ByteLevelBPETokenizer
+from transformers import RobertaConfig, RobertaModel
+
+"""
+Tiny fixture for running the code search benchmark offline. The corpus is a bundled sample of the documented functions
+of the python standard library (CPython, PSF license), the tokenizer is a byte level BPE trained on it and the model is
+a two layer RoBERTa with random weights. The corpus is pinned by the hash of the bundled file and everything else is
+generated from a fixed seed, so the fixture needs neither a download nor the fine-tuned CodeBERT checkpoint.
+
+The random model gives meaningless rankings, so MRR on the fixture says nothing about retrieval quality. The fixture is
+meant for comparing the search modes against each other, by their recall of the exhaustive results, and for measuring
+latency and memory.
+
+The bundled corpus was harvested from the standard library of CPython 3.11 with stdlib_functions, rewriting it changes
+its hash:
+    python benchmark_fixture.py --write-corpus
+"""
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+FIXTURE_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_fixture.jsonl.gz")
+FIXTURE_CORPUS_SHA1 = "e68a552e8f0eb28ee669093620d3e5c3ce3131fc"
+# Fields of the bundled records, the token lists are derived from the code and the docstring when it is read
+_BUNDLED_FIELDS = ("repo", "path", "func_name", "url", "code", "docstring")
+
+
+def with_tokens(js: dict) -> dict:
+    js["code_tokens"] = _TOKEN_PATTERN.findall(js["code"])
+    js["docstring_tokens"] = _TOKEN_PATTERN.findall(js["docstring"].split("\n\n")[0])
+    return js
+
+
+def stdlib_functions() -> Iterator[dict]:
+    # Records in the format of codebase.jsonl for every function of the running standard library which has a docstring
+    stdlib = sysconfig.get_paths()["stdlib"]
+    for path in sorted(glob(os.path.join(stdlib, "*.py"))):
+        try:
+            with open(path, encoding="UTF-8") as f:
+                source = f.read()
+            tree = ast.parse(source)
+        except (SyntaxError, UnicodeDecodeError):
+            continue
+        module = os.path.basename(path)[:-3]
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.FunctionDef):
+                continue
+            docstring = ast.get_docstring(node)
+            code = ast.get_source_segment(source, node)
+            if not docstring or not code:
+                continue
+            yield with_tokens({
+                "repo": "python/cpython",
+                "path": "Lib/{}.py".format(module),
+                "func_name": "{}.{}".format(module, node.name),
+                "url": "https://github.com/python/cpython/blob/main/Lib/{}.py#L{}".format(module, node.lineno),
+                "code": code,
+                "docstring": docstring,
+            })
+
+
+def write_fixture_corpus(file_path: str = FIXTURE_CORPUS_PATH, n_records: int = 2000) -> str:
+    # Bundles the first n_records functions of the running standard library, returns the hash to pin
+    lines = []
+    for js in stdlib_functions():
+        lines.append(json.dumps({field: js[field] for field in _BUNDLED_FIELDS}) + "\n")
+        if len(lines) == n_records:
+            break
+    raw = "".join(lines).encode("UTF-8")
+    # Without a timestamp in the gzip header the same records always give the same file
+    with open(file_path, "wb") as f:
+        f.write(gzip.compress(raw, mtime=0))
+    return hashlib.sha1(raw).hexdigest()
+
+
+def fixture_records(file_path: str = FIXTURE_CORPUS_PATH) -> List[dict]:
+    with gzip.open(file_path, "rb") as f:
+        raw = f.read()
+    if hashlib.sha1(raw).hexdigest() != FIXTURE_CORPUS_SHA1:
+        raise ValueError("Fixture corpus {} does not match the pinned hash {}".format(file_path, FIXTURE_CORPUS_SHA1))
+    return [with_tokens(json.loads(line)) for line in raw.decode("UTF-8").splitlines()]
+
+
+def make_fixture(directory: str, n_records: int = 2000, vocab_size: int = 4000, seed: int = 0) -> dict:
+    # Returns the paths of the corpus, the tokenizer and the model, existing files are reused
+    paths = {
+        "corpus_path": os.path.join(directory, "codebase.jsonl"),
+        "tokenizer_path": os.path.join(directory, "tokenizer"),
+        "model_path": os.path.join(directory, "model"),
+    }
+    if os.path.exists(os.path.join(paths["model_path"], "config.json")):
+        return paths
+    os.makedirs(paths["tokenizer_path"], exist_ok=True)
+
+    records = fixture_records()[:n_records]
+    with open(paths["corpus_path"], "w", encoding="UTF-8") as f:
+        for js in records:
+            f.write(json.dumps(js) + "\n")
+
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(
+        (js["code"] + "\n" + js["docstring"] for js in records),
+        vocab_size=vocab_size,
+        special_tokens=["<s>", "<pad>", "</s>", "<unk>", "<mask>"],
+        show_progress=False,
+    )
+    tokenizer.save_model(paths["tokenizer_path"])
+    with open(os.path.join(paths["tokenizer_path"], "tokenizer_config.json"), "w") as f:
+        json.dump({"model_max_length": 512}, f)
+
+    torch.manual_seed(seed)
+    config = RobertaConfig(
+        vocab_size=tokenizer.get_vocab_size(),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+        max_position_embeddings=514,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+    )
+    # The model directory is written last, it marks the fixture as complete
+    RobertaModel(config).save_pretrained(paths["model_path"])
+    return paths
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rewrite the bundled fixture corpus from the running standard library")
+    parser.add_argument("--write-corpus", action="store_true", required=True)
+    parser.add_argument("--n-records", type=int, default=2000)
+    args = parser.parse_args()
+    corpus_sha1 = write_fixture_corpus(n_records=args.n_records)
+    print("Wrote {}, pin FIXTURE_CORPUS_SHA1 = \"{}\"".format(FIXTURE_CORPUS_PATH, corpus_sha1))
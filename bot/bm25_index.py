@@ -0,0 +1,195 @@
+import os
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from vector_search import top_k
+
+"""
+BM25 inverted index over the code_tokens and docstring_tokens of the corpus. Identifiers are indexed as a whole and
+split into their snake_case and camelCase parts, so "DataFrame.merge" matches the tokens "DataFrame" and "merge".
+
+The index is used next to the dense embeddings, either to prefilter the candidates which are scored with the
+embeddings or to fuse the lexical and the dense ranking with reciprocal rank fusion.
+"""
+
+_SPLIT_PATTERN = re.compile(r"[^0-9A-Za-z_]+")
+_SUBTOKEN_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def tokenize(text_or_tokens) -> List[str]:
+    # Accepts a query string or the token list of a record
+    tokens = _SPLIT_PATTERN.split(text_or_tokens) if isinstance(text_or_tokens, str) else text_or_tokens
+    terms = []
+    for token in tokens:
+        for part in _SPLIT_PATTERN.split(token):
+            if len(part) == 0:
+                continue
+            terms.append(part.lower())
+            subtokens = _SUBTOKEN_PATTERN.findall(part)
+            if len(subtokens) > 1:
+                terms.extend(subtoken.lower() for subtoken in subtokens)
+    return terms
+
+
+def record_terms(js: dict) -> List[str]:
+    return tokenize(js["code_tokens"]) + tokenize(js.get("docstring_tokens", []))
+
+
+class BM25Index:
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        posting_offsets: np.ndarray,
+        posting_ids: np.ndarray,
+        posting_freqs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary.tolist())}
+        # The documents containing term i are posting_ids[posting_offsets[i]:posting_offsets[i + 1]]
+        self.posting_offsets = posting_offsets
+        self.posting_ids = posting_ids
+        self.posting_freqs = posting_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) > 0 else 0.0
+        # Identity of the corpus the index was built from
+        self.source = ""
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, records: Iterable[dict], k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        term_ids: Dict[str, int] = {}
+        doc_lengths = []
+        postings_terms, postings_docs, postings_freqs = [], [], []
+        for doc, js in enumerate(records):
+            terms = record_terms(js)
+            doc_lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                postings_terms.append(term_ids.setdefault(term, len(term_ids)))
+                postings_docs.append(doc)
+                postings_freqs.append(freq)
+
+        # Postings are grouped by term, within a term the documents stay in corpus order
+        postings_terms = np.array(postings_terms, dtype=np.int64)
+        order = np.argsort(postings_terms, kind="stable")
+        posting_offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(postings_terms, minlength=len(term_ids)), out=posting_offsets[1:])
+        vocabulary = np.empty(len(term_ids), dtype=object)
+        for term, i in term_ids.items():
+            vocabulary[i] = term
+        return cls(
+            vocabulary.astype(str),
+            posting_offsets,
+            np.array(postings_docs, dtype=np.int32)[order],
+            np.array(postings_freqs, dtype=np.float32)[order],
+            np.array(doc_lengths, dtype=np.float32),
+            k1=k1,
+            b=b,
+        )
+
+    def save(self, file_path: str):
+        # Written next to the target and moved into place, other workers never load a partly written index
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vocabulary=self.vocabulary,
+                posting_offsets=self.posting_offsets,
+                posting_ids=self.posting_ids,
+                posting_freqs=self.posting_freqs,
+                doc_lengths=self.doc_lengths,
+                parameters=np.array([self.k1, self.b]),
+                source=self.source,
+            )
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> "BM25Index":
+        with np.load(file_path) as data:
+            k1, b = data["parameters"].tolist()
+            bm25_index = cls(
+                data["vocabulary"],
+                data["posting_offsets"],
+                data["posting_ids"],
+                data["posting_freqs"],
+                data["doc_lengths"],
+                k1=k1,
+                b=b,
+            )
+            bm25_index.source = str(data["source"]) if "source" in data.files else ""
+            return bm25_index
+
+    def scores(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        # Only documents which contain at least one query term get a score, returned as sorted ids and their scores
+        query_terms = [self.term_ids[term] for term in set(tokenize(query)) if term in self.term_ids]
+        if len(query_terms) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, contributions = [], []
+        for term in query_terms:
+            start, end = self.posting_offsets[term], self.posting_offsets[term + 1]
+            docs = self.posting_ids[start:end]
+            freqs = self.posting_freqs[start:end]
+            idf = np.log(1 + (len(self) - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.average_length)
+            ids.append(docs)
+            contributions.append(idf * freqs * (self.k1 + 1) / (freqs + norm))
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        return ids.astype(np.int64), np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+
+    def search(self, query: str, k: int, rows: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        # rows optionally restricts the results to a sorted subset of the documents
+        ids, scores = self.scores(query)
+        if rows is not None:
+            allowed = np.isin(ids, rows, assume_unique=True)
+            ids, scores = ids[allowed], scores[allowed]
+        positions, scores = top_k(scores, k)
+        return ids[positions], scores
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int, rrf_k: int = 60) -> Tuple[np.ndarray, np.ndarray]:
+    # Every ranking adds 1 / (rrf_k + rank) to its documents, so no score calibration between rankings is needed
+    ids = np.concatenate([np.asarray(ranking, dtype=np.int64) for ranking in rankings])
+    if len(ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    contributions = np.concatenate([1 / (rrf_k + np.arange(1, len(ranking) + 1)) for ranking in rankings])
+    ids, inverse = np.unique(ids, return_inverse=True)
+    positions, scores = top_k(np.bincount(inverse, weights=contributions), k)
+    return ids[positions], scores
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from record_store import RecordStore
+
+    parser = argparse.ArgumentParser(description="Build the BM25 index of a jsonl corpus")
+    parser.add_argument("corpus_path")
+    parser.add_argument("index_path")
+    parser.add_argument("--query", nargs="*", default=[], help="Queries to print the top results for")
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = RecordStore(args.corpus_path)
+    build_start = time.perf_counter()
+    bm25_index = BM25Index.build(corpus)
+    bm25_index.source = corpus.identity
+    print("Indexed {} records with {} terms in {:.1f}s".format(
+        len(bm25_index), len(bm25_index.vocabulary), time.perf_counter() - build_start
+    ))
+    bm25_index.save(args.index_path)
+    for query in args.query:
+        query_start = time.perf_counter()
+        ids, bm25_scores = bm25_index.search(query, args.k)
+        print("{} ({:.2f}ms)".format(query, 1000 * (time.perf_counter() - query_start)))
+        for index, score in zip(ids, bm25_scores):
+            print("  {:.3f} {}".format(score, corpus[int(index)].get("func_name", int(index))))
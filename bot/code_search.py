@@ -1,68 +1,415 @@
-import torch
+import logging
+import os
+import threading
+import zipfile
 import numpy as np
 
-from tqdm import tqdm
-from torch import nn
+from typing import List, Tuple
 from abc import ABC, abstractmethod
-from transformers import RobertaTokenizer, RobertaModel
-from text_dataset import TextDataset
-from torch.utils.data import DataLoader, SequentialSampler
+from transformers import RobertaTokenizerFast, RobertaModel
+from codebert_model import Model, CodeEncoder, QueryEncoder, quantize_dynamic_int8
+from record_store import RecordStore
+from embedding_store import EmbeddingStore, convert_npy_to_store, model_fingerprint
+from vector_search import ShardedScorer, block_scores, top_k, top_k_of_rows, top_k_rows
+from ann_index import IVFIndex
+from quantization import VectorQuantizer, load_quantizer, train_quantizer
+from query_cache import QueryEmbeddingCache
+from embedding_builder import EmbeddingBuilder
+from bm25_index import BM25Index, reciprocal_rank_fusion, tokenize
+from export_encoder import RUNTIMES, configure_threads, default_export_path, load_query_model
+from metadata_index import MetadataIndex
+from near_duplicates import DuplicateMap
+from semantic_cache import SemanticResultCache
+
+logger = logging.getLogger(__name__)
+
+# A saved index which can not be read, e.g. one truncated by a crash, is rebuilt instead of failing the startup
+UNREADABLE_INDEX_ERRORS = (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile)
 
 
 class CodeSearch(ABC):
     @abstractmethod
-    def find_code_for_query(self, query: str) -> str:
+    def find_code_for_query_topk(self, query: str, k: int) -> List[Tuple[int, float, str]]:
         pass
 
+    def find_code_for_query(self, query: str) -> str:
+        return self.find_code_for_query_topk(query, 1)[0][2]
 
-class Model(nn.Module):
-    def __init__(self, encoder):
-        super(Model, self).__init__()
-        self.encoder = encoder
 
-    def forward(self, code_inputs=None, nl_inputs=None):
-        if code_inputs is not None:
-            return self.encoder(code_inputs, attention_mask=code_inputs.ne(1))[1]
+class RobertaCodeSearch(CodeSearch):
+    def __init__(
+        self,
+        recompute_embeddings: bool = False,
+        model_path: str = "python_model/",
+        embeddings_file: str = "./embeddings.npy",
+        embedding_store_file: str = "./embeddings.store",
+        codebase_file: str = "codebase.jsonl",
+        use_ann_index: bool = False,
+        ann_index_file: str = "./embeddings.ivf.npz",
+        nprobe: int = 8,
+        quantization: str = None,
+        rerank_candidates: int = 100,
+        query_cache_size: int = 1024,
+        query_cache_ttl: float = None,
+        query_cache_file: str = None,
+        n_shards: int = 1,
+        hybrid: str = None,
+        bm25_index_file: str = "./codebase.bm25.npz",
+        lexical_candidates: int = 1000,
+        quantize_query_encoder: bool = False,
+        query_runtime: str = "eager",
+        exported_model_file: str = None,
+        intra_op_threads: int = None,
+        inter_op_threads: int = None,
+        micro_batch_wait_ms: float = None,
+        micro_batch_size: int = 32,
+        quantized_file: str = None,
+        tokenizer_name: str = "microsoft/codebert-base",
+        store_dtype: str = "float32",
+        normalize_embeddings: bool = False,
+        metadata_index_file: str = "./codebase.meta.npz",
+        model: Model = None,
+        query_encoder: QueryEncoder = None,
+        duplicates_file: str = None,
+        semantic_cache_size: int = 0,
+        semantic_cache_threshold: float = 0.95,
+    ):
+        # The model and the query encoder of another instance can be shared, see index_versions.py. A shared model
+        # keeps the fingerprint of the checkpoint it was loaded from, model_path may hold another one by now.
+        if model is None:
+            model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=model_path))
+            self.model_fingerprint = model_fingerprint(model_path)
+        elif query_encoder is not None and query_encoder.fingerprint is not None:
+            self.model_fingerprint = query_encoder.fingerprint
+        else:
+            raise ValueError("A shared model needs the query encoder which carries its fingerprint")
+        self.model = model
+        if query_encoder is not None:
+            self.tokenizer = query_encoder.tokenizer
+            self.query_model = query_encoder.model
+            self.query_cache = query_encoder.query_cache
+            self.query_encoder = query_encoder
         else:
-            return self.encoder(nl_inputs, attention_mask=nl_inputs.ne(1))[1]
+            self.tokenizer = RobertaTokenizerFast.from_pretrained(tokenizer_name)
+            # Queries can be encoded by an int8 copy of the model or by an exported graph (see export_encoder.py), the
+            # corpus is always encoded by the eager float model
+            if query_runtime not in RUNTIMES:
+                raise ValueError("Unknown query runtime {}, expected one of {}".format(query_runtime, RUNTIMES))
+            if quantize_query_encoder and query_runtime != "eager":
+                raise ValueError("The int8 query encoder is only available with the eager runtime")
+            if query_runtime == "eager":
+                configure_threads(intra_op_threads, inter_op_threads)
+                self.query_model = quantize_dynamic_int8(self.model) if quantize_query_encoder else self.model
+            else:
+                self.query_model = load_query_model(
+                    query_runtime,
+                    exported_model_file or default_export_path(query_runtime),
+                    fingerprint=self.model_fingerprint,
+                    intra_op_threads=intra_op_threads,
+                    inter_op_threads=inter_op_threads,
+                )
+            self.query_cache = None
+            if query_cache_size > 0:
+                # Embeddings of the int8 model differ slightly, they must not be mixed with cached float embeddings
+                self.query_cache = QueryEmbeddingCache(
+                    self.model_fingerprint + (":int8" if quantize_query_encoder else ""),
+                    max_size=query_cache_size,
+                    ttl_seconds=query_cache_ttl,
+                    persist_path=query_cache_file,
+                )
+            self.query_encoder = QueryEncoder(
+                self.tokenizer, self.query_model, query_cache=self.query_cache, fingerprint=self.model_fingerprint
+            )
+            if micro_batch_wait_ms is not None:
+                # Concurrent requests are encoded together, each waits at most micro_batch_wait_ms for the others
+                self.query_encoder.enable_micro_batching(
+                    max_batch_size=micro_batch_size, max_wait_ms=micro_batch_wait_ms
+                )
+        # Records are only read when they are returned as a search result
+        self.code_records = RecordStore(codebase_file)
+        # A corpus deduplicated by near_duplicates.py maps its rows back to the collapsed duplicates
+        self.duplicate_map = None
+        if duplicates_file is not None:
+            self.duplicate_map = DuplicateMap.load(duplicates_file)
+            if len(self.duplicate_map) != len(self.code_records):
+                raise ValueError("Duplicate map {} does not belong to corpus {}".format(duplicates_file, codebase_file))
+
+        if recompute_embeddings:
+            # Only new or changed records are encoded, all others are taken over from the existing store
+            code_encoder = CodeEncoder(self.tokenizer, self.model, self.model_fingerprint)
+            EmbeddingBuilder(
+                codebase_file, embedding_store_file, dtype=store_dtype, normalize=normalize_embeddings
+            ).build(code_encoder)
+        # A new store can hold unit-normalized float16 vectors, the format of an existing store is read from its header
+        self.embedding_store = self._open_embedding_store(
+            embeddings_file, embedding_store_file, store_dtype, normalize_embeddings
+        )
+        self.vecs = self.embedding_store.vectors
+        # Row i of the store is the embedding of record i, a store of another corpus fails here and not at query time
+        if len(self.code_records) != len(self.embedding_store):
+            raise ValueError(
+                "Embedding store {} has {} vectors but corpus {} has {} records".format(
+                    embedding_store_file, len(self.embedding_store), codebase_file, len(self.code_records)
+                )
+            )
 
+        # Ranked results of recent queries, reused for later queries whose embedding is within the cosine threshold
+        self.semantic_cache = None
+        if semantic_cache_size > 0:
+            self.semantic_cache = SemanticResultCache(
+                self.embedding_store.dim,
+                max_size=semantic_cache_size,
+                threshold=semantic_cache_threshold,
+                ttl_seconds=query_cache_ttl,
+            )
 
-class RobertaCodeSearch(CodeSearch):
-    def __init__(self, recompute_embeddings: bool = False):
-        self.tokenizer = RobertaTokenizer.from_pretrained("microsoft/codebert-base")
-        self.model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path="python_model/"))
-        self.query_dataset = TextDataset(self.tokenizer, "codebase.jsonl")
+        # Exhaustive scoring runs over n_shards row ranges of the embedding matrix in parallel
+        self.sharded_scorer = None
+        if n_shards > 1:
+            self.sharded_scorer = ShardedScorer(self.vecs, n_shards)
 
-        if recompute_embeddings:
-            codebase_file = ""
-            query_dataset = TextDataset(self.tokenizer, codebase_file)
-            query_sampler = SequentialSampler(query_dataset)
-            query_dataloader = DataLoader(
-                query_dataset, sampler=query_sampler, batch_size=128, num_workers=4
+        self.ann_index = None
+        if use_ann_index:
+            self.ann_index = self._open_ann_index(ann_index_file, nprobe)
+
+        # Optional "sq8" or "pq" codes which are scanned instead of the float vectors
+        self.quantizer = None
+        self.rerank_candidates = rerank_candidates
+        if quantization is not None:
+            self.quantizer = self._open_quantizer(
+                quantization, quantized_file or "./embeddings.{}.npz".format(quantization)
             )
 
-            code_vecs = []
+        # Posting lists over repo, module, path, url and function name, opened on the first filtered query
+        self.metadata_index_file = metadata_index_file
+        self.metadata_index = None
+        self._metadata_lock = threading.Lock()
 
-            for batch in tqdm(query_dataloader):
-                code_inputs = batch[0]
-                with torch.no_grad():
-                    code_vec = self.model(code_inputs=code_inputs)
-                    code_vecs.append(code_vec.cpu().numpy())
+        # Optional lexical retrieval, "prefilter" scores only the BM25 candidates with the embeddings and "rrf" fuses
+        # the BM25 and the dense ranking
+        if hybrid not in (None, "prefilter", "rrf"):
+            raise ValueError("Unknown hybrid mode {}, expected prefilter or rrf".format(hybrid))
+        self.hybrid = hybrid
+        self.lexical_candidates = lexical_candidates
+        self.bm25_index = None
+        if hybrid is not None:
+            self.bm25_index = self._open_bm25_index(bm25_index_file)
 
-            # Delete last embedding to have a valid shape
-            code_vecs = np.delete(code_vecs, -1)
+    def _open_embedding_store(
+        self, embeddings_file: str, embedding_store_file: str, store_dtype: str, normalize_embeddings: bool
+    ) -> EmbeddingStore:
+        # The store is created once from the legacy .npy file, afterwards every worker maps the same file read-only.
+        # Workers which start together convert it concurrently, the first completed store is kept and opened by all.
+        if not os.path.exists(embedding_store_file):
+            convert_npy_to_store(
+                embeddings_file,
+                embedding_store_file,
+                self.model_fingerprint,
+                dtype=store_dtype,
+                normalize=normalize_embeddings,
+                overwrite=False,
+            )
+        embedding_store = EmbeddingStore(embedding_store_file)
+        if embedding_store.fingerprint != self.model_fingerprint:
+            raise ValueError(
+                "Embedding store {} was computed with a different model, recompute the embeddings".format(
+                    embedding_store_file
+                )
+            )
+        return embedding_store
 
-            vecs = np.vstack(code_vecs)
-            self.vecs = torch.from_numpy(vecs)
-        else:
-            self.vecs = torch.from_numpy(np.load(file="./embeddings.npy"))
+    def _open_ann_index(self, ann_index_file: str, nprobe: int) -> IVFIndex:
+        # The index is persisted next to the embeddings and rebuilt when it was built from another store
+        if os.path.exists(ann_index_file):
+            try:
+                ann_index = IVFIndex.load(ann_index_file, nprobe=nprobe)
+            except UNREADABLE_INDEX_ERRORS as error:
+                logger.warning("Could not read the ANN index %s (%r), rebuilding it", ann_index_file, error)
+            else:
+                if ann_index.source == self.embedding_store.identity:
+                    ann_index.attach(self.vecs)
+                    return ann_index
+        ann_index = IVFIndex.build(self.vecs, nprobe=nprobe)
+        ann_index.source = self.embedding_store.identity
+        ann_index.save(ann_index_file)
+        return ann_index
 
-    def find_code_for_query(self, query: str) -> str:
-        query_vec = self.model(self.tokenizer(query, return_tensors="pt")["input_ids"])
-        scores = torch.einsum("ab,cb->ac", query_vec, self.vecs)
-        scores = torch.softmax(scores, -1).detach().numpy()
-        scores = np.squeeze(scores)
-        scores = scores.argsort()[-5:][::-1]
-        result = self.query_dataset.data[scores[0]]
-
-        return result["code"]
+    def _open_quantizer(self, quantization: str, quantized_file: str) -> VectorQuantizer:
+        # Codes are only reused for the store they were computed from, a rebuilt store can keep its number of rows
+        if os.path.exists(quantized_file):
+            try:
+                quantizer = load_quantizer(quantized_file)
+            except UNREADABLE_INDEX_ERRORS as error:
+                logger.warning("Could not read the quantized codes %s (%r), retraining them", quantized_file, error)
+            else:
+                if quantizer.name == quantization and quantizer.source == self.embedding_store.identity:
+                    return quantizer
+        quantizer = train_quantizer(quantization, self.vecs)
+        quantizer.source = self.embedding_store.identity
+        quantizer.save(quantized_file)
+        return quantizer
+
+    def _open_bm25_index(self, bm25_index_file: str) -> BM25Index:
+        # Postings are only reused for the corpus file they were built from
+        if os.path.exists(bm25_index_file):
+            try:
+                bm25_index = BM25Index.load(bm25_index_file)
+            except UNREADABLE_INDEX_ERRORS as error:
+                logger.warning("Could not read the BM25 index %s (%r), rebuilding it", bm25_index_file, error)
+            else:
+                if bm25_index.source == self.code_records.identity:
+                    return bm25_index
+        bm25_index = BM25Index.build(self.code_records)
+        bm25_index.source = self.code_records.identity
+        bm25_index.save(bm25_index_file)
+        return bm25_index
+
+    def _open_metadata_index(self) -> MetadataIndex:
+        # Posting lists are only reused for the corpus file they were built from
+        if os.path.exists(self.metadata_index_file):
+            try:
+                metadata_index = MetadataIndex.load(self.metadata_index_file)
+            except UNREADABLE_INDEX_ERRORS as error:
+                logger.warning(
+                    "Could not read the metadata index %s (%r), rebuilding it", self.metadata_index_file, error
+                )
+            else:
+                if metadata_index.source == self.code_records.identity:
+                    return metadata_index
+        metadata_index = MetadataIndex.build(self.code_records)
+        metadata_index.source = self.code_records.identity
+        metadata_index.save(self.metadata_index_file)
+        return metadata_index
+
+    def filter_rows(self, filter_expression: str) -> np.ndarray:
+        # Sorted rows of the records which match a filter expression like "repo:pandas-dev/pandas func:read_"
+        if self.metadata_index is None:
+            # Concurrent first requests wait for one build instead of each building and saving the index
+            with self._metadata_lock:
+                if self.metadata_index is None:
+                    self.metadata_index = self._open_metadata_index()
+        return self.metadata_index.rows_of(self.metadata_index.filter(filter_expression))
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        return self.query_encoder.encode(queries)
+
+    def search_vectors(
+        self, query_vecs: np.ndarray, k: int, rows: np.ndarray = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # The raw dot products are returned, a softmax over the whole corpus would not change the ranking. Against a
+        # normalized store these are cosine similarities, which are comparable across queries.
+        if rows is not None:
+            # Only the rows of a metadata filter are scored exactly, they are gathered from the mapped buffer in
+            # bounded blocks and a filter which matches most of the corpus is scored in place
+            indices, scores = top_k_of_rows(query_vecs, self.vecs, rows, k)
+            return list(zip(indices, scores))
+        if self.ann_index is not None:
+            return [self.ann_index.search(query_vec, k) for query_vec in query_vecs]
+        elif self.quantizer is not None:
+            # Candidates from the compressed scan are re-ranked with their float vectors
+            return [
+                self.quantizer.search(query_vec, k, self.vecs, rerank_candidates=self.rerank_candidates)
+                for query_vec in query_vecs
+            ]
+        if self.sharded_scorer is not None:
+            indices, scores = self.sharded_scorer.top_k(query_vecs, k)
+            return list(zip(indices, scores))
+        # A single matrix-matrix product of all queries against the mapped buffer, no copy of the corpus is made
+        indices, scores = top_k_rows(block_scores(query_vecs, self.vecs), k)
+        return list(zip(indices, scores))
+
+    def hybrid_search(
+        self, queries: List[str], query_vecs: np.ndarray, k: int, rows: np.ndarray = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self.hybrid == "rrf":
+            dense_hits = self.search_vectors(query_vecs, max(k, self.lexical_candidates), rows=rows)
+            return [
+                reciprocal_rank_fusion(
+                    [self.bm25_index.search(query, self.lexical_candidates, rows=rows)[0], dense_ids], k
+                )
+                for query, (dense_ids, _) in zip(queries, dense_hits)
+            ]
+        hits = []
+        for query, query_vec in zip(queries, query_vecs):
+            candidates, _ = self.bm25_index.search(query, self.lexical_candidates, rows=rows)
+            if len(candidates) == 0:
+                # Without a single matching term the query falls back to the dense search over the whole corpus
+                hits.extend(self.search_vectors(query_vec[None, :], k, rows=rows))
+                continue
+            candidates = np.sort(candidates)
+            positions, scores = top_k(np.asarray(self.vecs[candidates], dtype=np.float32) @ query_vec, k)
+            hits.append((candidates[positions], scores))
+        return hits
+
+    def duplicates_of(self, index: int) -> List[Tuple[int, str]]:
+        # Rows in the original corpus and urls of the near-duplicates which were collapsed into a search result
+        if self.duplicate_map is None:
+            return []
+        return self.duplicate_map.duplicates_of(index)
+
+    def close(self):
+        # Releases the record store file and the scoring threads, the mapped vectors go with the last reference
+        self.code_records.close()
+        if self.sharded_scorer is not None:
+            self.sharded_scorer.close()
+
+    def _results(self, indices: np.ndarray, scores: np.ndarray) -> List[Tuple[int, float, str]]:
+        return [
+            (int(index), float(score), self.code_records[int(index)]["code"])
+            for index, score in zip(indices, scores)
+        ]
+
+    def find_code_for_query_topk(
+        self, query: str, k: int, filter_expression: str = None
+    ) -> List[Tuple[int, float, str]]:
+        return self.find_code_for_queries([query], k=k, filter_expression=filter_expression)[0]
+
+    def find_code_for_queries(
+        self, queries: List[str], k: int = 1, batch_size: int = 32, filter_expression: str = None
+    ) -> List[List[Tuple[int, float, str]]]:
+        # An empty filter matches every record, it is searched like no filter
+        if filter_expression is not None and filter_expression.strip() == "":
+            filter_expression = None
+        rows = None
+        if filter_expression is not None:
+            rows = self.filter_rows(filter_expression)
+            if len(rows) == 0:
+                return [[] for _ in queries]
+        results = []
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            query_vecs = self.encode_queries(batch)
+            batch_results = [None] * len(batch)
+            if self.semantic_cache is not None:
+                batch_results = [
+                    self.semantic_cache.get(query_vec, k, self._cache_context(query, filter_expression))
+                    for query, query_vec in zip(batch, query_vecs)
+                ]
+            # Only the queries without a cached paraphrase are searched
+            misses = [i for i, cached in enumerate(batch_results) if cached is None]
+            if len(misses) > 0:
+                miss_vecs = self.embedding_store.prepare_queries(query_vecs[misses])
+                if self.bm25_index is not None:
+                    hits = self.hybrid_search([batch[i] for i in misses], miss_vecs, k, rows=rows)
+                else:
+                    hits = self.search_vectors(miss_vecs, k, rows=rows)
+                for i, (indices, scores) in zip(misses, hits):
+                    batch_results[i] = self._results(indices, scores)
+                    if self.semantic_cache is not None:
+                        self.semantic_cache.put(
+                            query_vecs[i], k, self._cache_context(batch[i], filter_expression), batch_results[i]
+                        )
+            results.extend(batch_results)
+        return results
+
+    def _cache_context(self, query: str, filter_expression: str):
+        # A cached result is only reused for the same filter, in a hybrid search also for the same BM25 terms
+        if self.bm25_index is None:
+            return filter_expression
+        return filter_expression, " ".join(sorted(set(tokenize(query))))
+
+    def cache_stats(self) -> dict:
+        return {
+            "query_embeddings": self.query_cache.stats() if self.query_cache is not None else None,
+            "semantic_results": self.semantic_cache.stats() if self.semantic_cache is not None else None,
+        }
@@ -0,0 +1,102 @@
+import copy
+from typing import List, Optional
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import RobertaTokenizerFast, RobertaModel
+
+from embedding_store import model_fingerprint
+from micro_batcher import MicroBatcher
+from query_cache import QueryEmbeddingCache
+from text_dataset import convert_examples_to_features_batched
+
+
+class Model(nn.Module):
+    def __init__(self, encoder):
+        super(Model, self).__init__()
+        self.encoder = encoder
+
+    def forward(self, code_inputs=None, nl_inputs=None, attention_mask=None):
+        if code_inputs is not None:
+            if attention_mask is None:
+                attention_mask = code_inputs.ne(1)
+            return self.encoder(code_inputs, attention_mask=attention_mask)[1]
+        else:
+            if attention_mask is None:
+                attention_mask = nl_inputs.ne(1)
+            return self.encoder(nl_inputs, attention_mask=attention_mask)[1]
+
+
+def quantize_dynamic_int8(model: Model) -> Model:
+    # Weights of all linear layers are stored as int8, activations are quantized on the fly for every forward pass.
+    # The float model is left untouched, corpus embeddings should still be computed with it.
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+class CodeEncoder:
+    def __init__(self, tokenizer, model: Model, fingerprint: str, batch_size: int = 128):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.model.eval()
+        self.fingerprint = fingerprint
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_pretrained(cls, model_path: str = "python_model/", batch_size: int = 128) -> "CodeEncoder":
+        tokenizer = RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+        model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=model_path))
+        return cls(tokenizer, model, model_fingerprint(model_path), batch_size=batch_size)
+
+    @property
+    def dim(self) -> int:
+        return self.model.encoder.config.hidden_size
+
+    def encode(self, records: List[dict]) -> np.ndarray:
+        features = convert_examples_to_features_batched(records, self.tokenizer)
+        # Records are encoded in order of their length and every batch is only padded to its longest member
+        order = np.argsort([len(feature.code_tokens) for feature in features], kind="stable")
+        code_vecs = np.empty((len(records), self.dim), dtype=np.float32)
+        for start in range(0, len(records), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            max_length = max(len(features[i].code_tokens) for i in batch)
+            code_inputs = torch.tensor([features[i].code_ids[:max_length] for i in batch])
+            with torch.no_grad():
+                code_vecs[batch] = self.model(code_inputs=code_inputs).numpy()
+        return code_vecs
+
+
+class QueryEncoder:
+    def __init__(
+        self, tokenizer, model: Model, query_cache: Optional[QueryEmbeddingCache] = None, fingerprint: str = None
+    ):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.query_cache = query_cache
+        # Fingerprint of the checkpoint the model was loaded from, it travels with an encoder which is shared
+        self.fingerprint = fingerprint
+        self.micro_batcher = None
+
+    def enable_micro_batching(self, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        # Concurrent callers share padded forward passes, see micro_batcher.py
+        self.micro_batcher = MicroBatcher(self._encode, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def _encode(self, queries: List[str]) -> np.ndarray:
+        # One padded forward pass for all queries, the attention mask hides the padding of the shorter ones
+        inputs = self.tokenizer(queries, padding=True, truncation=True, return_tensors="pt")
+        with torch.no_grad():
+            return self.model(nl_inputs=inputs["input_ids"], attention_mask=inputs["attention_mask"]).numpy()
+
+    def encode(self, queries: List[str]) -> np.ndarray:
+        encode = self._encode if self.micro_batcher is None else self.micro_batcher.encode
+        if self.query_cache is None:
+            return encode(queries)
+        cached = [self.query_cache.get(query) for query in queries]
+        missing = [i for i, query_vec in enumerate(cached) if query_vec is None]
+        if len(missing) > 0:
+            # Only the queries which are not cached go through the encoder
+            query_vecs = encode([queries[i] for i in missing])
+            for i, query_vec in zip(missing, query_vecs):
+                self.query_cache.put(queries[i], query_vec)
+                cached[i] = query_vec
+        return np.stack(cached)
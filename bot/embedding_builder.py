@@ -0,0 +1,219 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import RobertaConfig
+
+from codebert_model import CodeEncoder
+from embedding_store import EmbeddingStore, EmbeddingStoreWriter, model_fingerprint
+from record_store import RecordStore
+
+"""
+Builds the embedding store of a jsonl corpus in chunks. Finished chunks are checkpointed in a work directory, so an
+interrupted build resumes where it stopped. Every record is keyed by a hash of its url and code, on later runs only
+records which are new or changed are encoded while all others are copied from the previous store.
+
+With build_parallel the pending chunks are encoded by several worker processes, each with its own model and torch
+thread budget. Every chunk is written to its own checkpoint, so the merged store keeps the corpus order.
+"""
+
+
+def record_key(js: dict) -> bytes:
+    sha = hashlib.sha1()
+    sha.update(js.get("url", "").encode("UTF-8"))
+    sha.update(b"\x00")
+    sha.update(" ".join(js["code_tokens"]).encode("UTF-8"))
+    return sha.hexdigest().encode("ascii")
+
+
+def keys_path(store_path: str) -> str:
+    return store_path + ".keys.npy"
+
+
+class EmbeddingBuilder:
+    def __init__(
+        self, corpus_path: str, store_path: str, chunk_size: int = 4096, dtype=np.float32, normalize: bool = False
+    ):
+        self.corpus_path = corpus_path
+        self.store_path = store_path
+        self.chunk_size = chunk_size
+        # Chunk checkpoints are float32, the dtype and normalization of the store are applied when merging
+        self.dtype = np.dtype(dtype)
+        self.normalize = normalize
+        self.work_dir = store_path + ".build"
+        self.records = RecordStore(corpus_path)
+        self._previous_vectors = None
+
+    @property
+    def n_chunks(self) -> int:
+        return (len(self.records) + self.chunk_size - 1) // self.chunk_size
+
+    def _chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.work_dir, "chunk_{:06d}.npz".format(chunk))
+
+    def _manifest(self, fingerprint: str) -> Dict:
+        return {
+            "corpus_size": os.path.getsize(self.corpus_path),
+            "corpus_mtime_ns": os.stat(self.corpus_path).st_mtime_ns,
+            "n_records": len(self.records),
+            "chunk_size": self.chunk_size,
+            "fingerprint": fingerprint,
+            "dtype": self.dtype.str,
+            "normalize": self.normalize,
+        }
+
+    def _prepare_work_dir(self, fingerprint: str):
+        # Checkpoints are only reused when they were written for the same corpus, chunking, model and store format
+        manifest = self._manifest(fingerprint)
+        manifest_path = os.path.join(self.work_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                if json.load(f) == manifest:
+                    return
+            shutil.rmtree(self.work_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    def _previous_embeddings(self, fingerprint: str) -> Dict[bytes, int]:
+        # Maps the key of every record of the previous build to its row in the previous store
+        if not (os.path.exists(self.store_path) and os.path.exists(keys_path(self.store_path))):
+            return {}
+        previous_store = EmbeddingStore(self.store_path)
+        if previous_store.fingerprint != fingerprint:
+            return {}
+        # Rows are only reused from a store of the same format, normalized float16 rows are no raw encoder outputs
+        if previous_store.header.dtype != self.dtype or previous_store.normalized != self.normalize:
+            return {}
+        previous_keys = np.load(keys_path(self.store_path))
+        if len(previous_keys) != len(previous_store):
+            return {}
+        self._previous_vectors = previous_store.vectors
+        return {key: row for row, key in enumerate(previous_keys.tolist())}
+
+    def pending_chunks(self) -> List[int]:
+        return [chunk for chunk in range(self.n_chunks) if not os.path.exists(self._chunk_path(chunk))]
+
+    def encode_chunk(self, chunk: int, encoder: CodeEncoder, previous_rows: Dict[bytes, int]) -> int:
+        start = chunk * self.chunk_size
+        records = [self.records[i] for i in range(start, min(start + self.chunk_size, len(self.records)))]
+        keys = [record_key(js) for js in records]
+        vectors = np.empty((len(records), encoder.dim), dtype=np.float32)
+
+        changed = [i for i, key in enumerate(keys) if key not in previous_rows]
+        unchanged = [i for i, key in enumerate(keys) if key in previous_rows]
+        if len(unchanged) > 0:
+            vectors[unchanged] = self._previous_vectors[[previous_rows[keys[i]] for i in unchanged]]
+        if len(changed) > 0:
+            vectors[changed] = encoder.encode([records[i] for i in changed])
+
+        tmp_path = self._chunk_path(chunk) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, vectors=vectors, keys=np.array(keys, dtype="S40"))
+        os.replace(tmp_path, self._chunk_path(chunk))
+        return len(changed)
+
+    def merge(self, fingerprint: str, dim: int):
+        keys = []
+        with EmbeddingStoreWriter(
+            self.store_path, dim, fingerprint, dtype=self.dtype, normalize=self.normalize
+        ) as writer:
+            for chunk in range(self.n_chunks):
+                with np.load(self._chunk_path(chunk)) as data:
+                    writer.append(data["vectors"])
+                    keys.append(data["keys"])
+        tmp_path = keys_path(self.store_path) + ".tmp.npy"
+        np.save(tmp_path, np.concatenate(keys) if len(keys) > 0 else np.array([], dtype="S40"))
+        os.replace(tmp_path, keys_path(self.store_path))
+        shutil.rmtree(self.work_dir)
+
+    def build(self, encoder: CodeEncoder) -> int:
+        # Returns the number of records which had to be encoded
+        self._prepare_work_dir(encoder.fingerprint)
+        previous_rows = self._previous_embeddings(encoder.fingerprint)
+        n_encoded = 0
+        for chunk in tqdm(self.pending_chunks()):
+            n_encoded += self.encode_chunk(chunk, encoder, previous_rows)
+        self.merge(encoder.fingerprint, encoder.dim)
+        return n_encoded
+
+    def build_parallel(
+        self, model_path: str, n_workers: int, threads_per_worker: int = None, batch_size: int = 128
+    ) -> int:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+        fingerprint = model_fingerprint(model_path)
+        self._prepare_work_dir(fingerprint)
+        # Workers are spawned instead of forked, a forked process would inherit the thread pools of torch
+        n_encoded = 0
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                self.corpus_path, self.store_path, self.chunk_size, self.dtype, self.normalize, model_path, batch_size,
+                threads_per_worker,
+            ),
+        ) as executor:
+            pending_chunks = self.pending_chunks()
+            for n_chunk_encoded in tqdm(
+                executor.map(_encode_chunk_in_worker, pending_chunks), total=len(pending_chunks)
+            ):
+                n_encoded += n_chunk_encoded
+        self.merge(fingerprint, RobertaConfig.from_pretrained(model_path).hidden_size)
+        return n_encoded
+
+
+# State of a worker process of EmbeddingBuilder.build_parallel
+_worker = {}
+
+
+def _init_worker(
+    corpus_path: str, store_path: str, chunk_size: int, dtype, normalize: bool, model_path: str, batch_size: int,
+    n_threads: int,
+):
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+    encoder = CodeEncoder.from_pretrained(model_path, batch_size=batch_size)
+    builder = EmbeddingBuilder(corpus_path, store_path, chunk_size=chunk_size, dtype=dtype, normalize=normalize)
+    _worker["encoder"] = encoder
+    _worker["builder"] = builder
+    _worker["previous_rows"] = builder._previous_embeddings(encoder.fingerprint)
+
+
+def _encode_chunk_in_worker(chunk: int) -> int:
+    return _worker["builder"].encode_chunk(chunk, _worker["encoder"], _worker["previous_rows"])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or update the embedding store of a jsonl corpus")
+    parser.add_argument("corpus_path")
+    parser.add_argument("store_path")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=1, help="Number of encoding processes")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--normalize", action="store_true", help="Store unit-normalized vectors for cosine scoring")
+    args = parser.parse_args()
+
+    builder = EmbeddingBuilder(
+        args.corpus_path, args.store_path, chunk_size=args.chunk_size, dtype=args.dtype, normalize=args.normalize
+    )
+    if args.workers > 1:
+        n_records_encoded = builder.build_parallel(
+            args.model_path, args.workers, threads_per_worker=args.threads_per_worker, batch_size=args.batch_size
+        )
+    else:
+        n_records_encoded = builder.build(CodeEncoder.from_pretrained(args.model_path, batch_size=args.batch_size))
+    print("Encoded {} of {} records".format(n_records_encoded, len(builder.records)))
@@ -0,0 +1,247 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from vector_search import block_scores
+
+"""
+On-disk embedding store which is opened read-only via mmap, so that all worker processes share one copy of the
+corpus vectors through the page cache.
+
+File layout: a fixed size header followed by a C-contiguous (count, dim) matrix.
+
+A store can hold unit-normalized vectors, usually as float16. Scores against it are cosine similarities computed as
+plain dot products with normalized queries, the float16 rows are upcast block by block while scoring.
+"""
+
+MAGIC = b"CSEMB\x00\x00\x01"
+VERSION = 2
+HEADER_SIZE = 128
+# magic, version, dtype, dim, count, model fingerprint
+_HEADER_FORMAT = "<8sH8sIQ40s"
+# Flags were added in version 2, version 1 stores have none
+_FLAGS_FORMAT = "<I"
+FLAG_NORMALIZED = 1
+
+# Content hashes of weight files by (path, size, mtime_ns), so a process hashes every checkpoint only once
+_file_hashes = {}
+
+
+def file_hash(file_path: str) -> str:
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+
+def model_fingerprint(model_path: str) -> str:
+    # Hash of the name and content of every file of the model directory. A fine-tuned checkpoint has weight files of
+    # the same size, so their content has to be hashed, which happens once per file version and process.
+    sha = hashlib.sha1()
+    for file_name in sorted(os.listdir(model_path)):
+        file_path = os.path.join(model_path, file_name)
+        if not os.path.isfile(file_path):
+            continue
+        sha.update(file_name.encode("UTF-8"))
+        sha.update(file_hash(file_path).encode("ascii"))
+    return sha.hexdigest()
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class EmbeddingStoreHeader:
+    def __init__(self, dtype, dim: int, count: int, fingerprint: str, normalized: bool = False):
+        self.dtype = np.dtype(dtype)
+        self.dim = dim
+        self.count = count
+        self.fingerprint = fingerprint
+        self.normalized = normalized
+
+    def pack(self) -> bytes:
+        header = struct.pack(
+            _HEADER_FORMAT,
+            MAGIC,
+            VERSION,
+            self.dtype.str.encode("ascii"),
+            self.dim,
+            self.count,
+            self.fingerprint.encode("ascii"),
+        )
+        header += struct.pack(_FLAGS_FORMAT, FLAG_NORMALIZED if self.normalized else 0)
+        return header.ljust(HEADER_SIZE, b"\x00")
+
+    @classmethod
+    def unpack(cls, raw: bytes) -> "EmbeddingStoreHeader":
+        if len(raw) < HEADER_SIZE:
+            raise ValueError("Embedding store header is truncated")
+        magic, version, dtype, dim, count, fingerprint = struct.unpack_from(_HEADER_FORMAT, raw)
+        if magic != MAGIC:
+            raise ValueError("File is not an embedding store")
+        if version not in (1, VERSION):
+            raise ValueError("Unsupported embedding store version {}".format(version))
+        flags = 0
+        if version >= 2:
+            flags, = struct.unpack_from(_FLAGS_FORMAT, raw, struct.calcsize(_HEADER_FORMAT))
+        return cls(
+            dtype.rstrip(b"\x00").decode("ascii"),
+            dim,
+            count,
+            fingerprint.rstrip(b"\x00").decode("ascii"),
+            normalized=bool(flags & FLAG_NORMALIZED),
+        )
+
+
+class EmbeddingStoreWriter:
+    """
+    Appends embedding chunks to a new store. The header is rewritten with the final count on close, and the file is
+    only moved to its target path once it is complete. Every process writes its own temp file, with overwrite=False a
+    store which another process completed first is kept.
+    """
+
+    def __init__(
+        self, file_path: str, dim: int, fingerprint: str, dtype=np.float32, normalize: bool = False,
+        overwrite: bool = True
+    ):
+        self.file_path = file_path
+        self.header = EmbeddingStoreHeader(dtype, dim, 0, fingerprint, normalized=normalize)
+        self.overwrite = overwrite
+        self._tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(self.header.pack())
+
+    def append(self, vectors: np.ndarray):
+        if self.header.normalized:
+            # Normalized in float32 before the vectors are narrowed to the dtype of the store
+            vectors = normalize_rows(vectors)
+        vectors = np.ascontiguousarray(vectors, dtype=self.header.dtype)
+        if vectors.ndim != 2 or vectors.shape[1] != self.header.dim:
+            raise ValueError("Expected vectors of shape (n, {}), got {}".format(self.header.dim, vectors.shape))
+        self._file.write(vectors.tobytes())
+        self.header.count += vectors.shape[0]
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(self.header.pack())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if self.overwrite:
+            os.replace(self._tmp_path, self.file_path)
+            return
+        try:
+            # A hard link fails instead of replacing the store of a process which finished first
+            os.link(self._tmp_path, self.file_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            os.replace(self._tmp_path, self.file_path)
+            return
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+
+class EmbeddingStore:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        with open(file_path, "rb") as f:
+            self.header = EmbeddingStoreHeader.unpack(f.read(HEADER_SIZE))
+        if self.header.count == 0:
+            self.vectors = np.empty((0, self.header.dim), dtype=self.header.dtype)
+        else:
+            self.vectors = np.memmap(
+                file_path,
+                dtype=self.header.dtype,
+                mode="r",
+                offset=HEADER_SIZE,
+                shape=(self.header.count, self.header.dim),
+            )
+
+    @property
+    def dim(self) -> int:
+        return self.header.dim
+
+    @property
+    def fingerprint(self) -> str:
+        return self.header.fingerprint
+
+    @property
+    def normalized(self) -> bool:
+        return self.header.normalized
+
+    @property
+    def identity(self) -> str:
+        # Indexes built from the store save its identity, a rebuilt store with the same number of rows differs in it
+        stat = os.stat(self.file_path)
+        return "{}:{}:{}".format(self.fingerprint, stat.st_size, stat.st_mtime_ns)
+
+    def __len__(self):
+        return self.header.count
+
+    def prepare_queries(self, query_vecs: np.ndarray) -> np.ndarray:
+        # Queries against a normalized store are normalized as well, so their dot products are cosine similarities
+        return normalize_rows(query_vecs) if self.normalized else np.asarray(query_vecs, dtype=np.float32)
+
+    def scores(self, query_vecs: np.ndarray) -> np.ndarray:
+        # Dot product of (q, dim) query vectors against the mapped (count, dim) matrix
+        return block_scores(self.prepare_queries(query_vecs), self.vectors)
+
+
+def write_embedding_store(
+    file_path: str, vectors: np.ndarray, fingerprint: str, dtype=None, normalize: bool = False
+):
+    dtype = vectors.dtype if dtype is None else dtype
+    with EmbeddingStoreWriter(file_path, vectors.shape[1], fingerprint, dtype=dtype, normalize=normalize) as writer:
+        writer.append(vectors)
+
+
+def convert_npy_to_store(
+    npy_path: str,
+    file_path: str,
+    fingerprint: str,
+    chunk_size: int = 65536,
+    dtype=None,
+    normalize: bool = False,
+    overwrite: bool = True,
+):
+    # The source array is mapped as well, so converting does not need the whole matrix in memory
+    vectors = np.load(npy_path, mmap_mode="r")
+    dtype = vectors.dtype if dtype is None else dtype
+    with EmbeddingStoreWriter(
+        file_path, vectors.shape[1], fingerprint, dtype=dtype, normalize=normalize, overwrite=overwrite
+    ) as writer:
+        for start in range(0, vectors.shape[0], chunk_size):
+            writer.append(vectors[start:start + chunk_size])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert an embeddings.npy file into an mmap embedding store")
+    parser.add_argument("npy_path")
+    parser.add_argument("store_path")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default=None, help="Default: dtype of the .npy")
+    parser.add_argument("--normalize", action="store_true", help="Store unit-normalized vectors for cosine scoring")
+    args = parser.parse_args()
+    convert_npy_to_store(
+        args.npy_path, args.store_path, model_fingerprint(args.model_path), dtype=args.dtype, normalize=args.normalize
+    )
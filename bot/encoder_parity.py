@@ -0,0 +1,117 @@
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from codebert_model import QueryEncoder
+from vector_search import top_k_rows
+
+"""
+Compares a candidate query encoder (e.g. the int8 quantized model) with the float reference encoder before it is
+enabled for serving. Queries are the docstrings of held-out corpus records and the relevant result of a query is the
+stored embedding of its own record, so the check runs against the embeddings that are actually served.
+
+Reported are the cosine drift of the query embeddings, the MRR of both encoders with its delta and the per query
+latency of both encoders at batch size 1.
+"""
+
+
+def cosine_similarities(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return (a * b).sum(axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+
+
+def mean_reciprocal_rank(query_vecs: np.ndarray, vectors: np.ndarray, relevant: np.ndarray, k: int) -> float:
+    indices, _ = top_k_rows(query_vecs @ vectors.T, k)
+    hits = indices == relevant[:, None]
+    ranks = hits.argmax(axis=1)
+    return float(np.where(hits.any(axis=1), 1 / (ranks + 1), 0.0).mean())
+
+
+def encode_timed(encoder: QueryEncoder, queries: List[str]):
+    # Queries are encoded one by one like in a /code-search request, returns the embeddings and latencies in ms
+    query_vecs, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        query_vecs.append(encoder.encode([query])[0])
+        latencies.append(1000 * (time.perf_counter() - start))
+    return np.stack(query_vecs), np.array(latencies)
+
+
+def parity_report(
+    reference: QueryEncoder, candidate: QueryEncoder, queries: List[str], vectors: np.ndarray, relevant: np.ndarray,
+    k: int = 100,
+) -> Dict:
+    # One warm-up pass per encoder, the first forward pass allocates the buffers of the model
+    reference.encode(queries[:1])
+    candidate.encode(queries[:1])
+    reference_vecs, reference_ms = encode_timed(reference, queries)
+    candidate_vecs, candidate_ms = encode_timed(candidate, queries)
+    drift = 1 - cosine_similarities(reference_vecs, candidate_vecs)
+    reference_mrr = mean_reciprocal_rank(reference_vecs, vectors, relevant, k)
+    candidate_mrr = mean_reciprocal_rank(candidate_vecs, vectors, relevant, k)
+    return {
+        "n_queries": len(queries),
+        "cosine_drift_mean": float(drift.mean()),
+        "cosine_drift_max": float(drift.max()),
+        "mrr@{}_reference".format(k): reference_mrr,
+        "mrr@{}_candidate".format(k): candidate_mrr,
+        "mrr_delta": candidate_mrr - reference_mrr,
+        "reference_ms_p50": float(np.percentile(reference_ms, 50)),
+        "reference_ms_p95": float(np.percentile(reference_ms, 95)),
+        "candidate_ms_p50": float(np.percentile(candidate_ms, 50)),
+        "candidate_ms_p95": float(np.percentile(candidate_ms, 95)),
+        "speedup": float(reference_ms.mean() / candidate_ms.mean()),
+    }
+
+
+def held_out_queries(records, n_queries: int, seed: int = 0):
+    # Docstrings of a random sample of records which have one, together with the rows of their records
+    rng = np.random.default_rng(seed)
+    queries, relevant = [], []
+    for i in rng.permutation(len(records)).tolist():
+        docstring_tokens = records[i].get("docstring_tokens", [])
+        if len(docstring_tokens) > 0:
+            queries.append(" ".join(docstring_tokens))
+            relevant.append(i)
+            if len(queries) == n_queries:
+                break
+    return queries, np.array(relevant, dtype=np.int64)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import torch
+    from transformers import RobertaTokenizerFast, RobertaModel
+
+    from codebert_model import Model, quantize_dynamic_int8
+    from embedding_store import EmbeddingStore, model_fingerprint
+    from record_store import RecordStore
+
+    parser = argparse.ArgumentParser(description="Check the int8 quantized query encoder against the float model")
+    parser.add_argument("store_path")
+    parser.add_argument("corpus_path")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--n-queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    store = EmbeddingStore(args.store_path)
+    if store.fingerprint != model_fingerprint(args.model_path):
+        raise ValueError("Embedding store {} was computed with a different model".format(args.store_path))
+    query_texts, relevant_rows = held_out_queries(RecordStore(args.corpus_path), args.n_queries)
+    tokenizer = RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+    float_model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=args.model_path)).eval()
+    report = parity_report(
+        QueryEncoder(tokenizer, float_model),
+        QueryEncoder(tokenizer, quantize_dynamic_int8(float_model)),
+        query_texts,
+        store.vectors,
+        relevant_rows,
+        k=args.k,
+    )
+    for name, value in report.items():
+        print("{:<24} {}".format(name, value))
@@ -0,0 +1,168 @@
+import torch
+from torch import nn
+from transformers import RobertaTokenizerFast, RobertaModel
+
+from codebert_model import Model
+from embedding_store import model_fingerprint
+
+"""
+Exports the query side of the CodeBERT Model wrapper to TorchScript or ONNX and loads the exported graphs as drop-in
+replacements of the eager model. The exported runtimes run without autograd and without the python overhead of the
+eager modules, their thread pools are configured explicitly.
+
+The fingerprint of the exported model is stored with the graph, so an export of an older model is refused.
+ONNX export and inference need the optional onnx and onnxruntime packages.
+"""
+
+RUNTIMES = ("eager", "torchscript", "onnx")
+
+
+class QueryGraph(nn.Module):
+    # Fixed positional signature of the query encoder, which is what tracing and ONNX export need
+    def __init__(self, model: Model):
+        super(QueryGraph, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(nl_inputs=input_ids, attention_mask=attention_mask)
+
+
+def configure_threads(intra_op_threads: int = None, inter_op_threads: int = None):
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # The inter-op pool can only be sized before its first use, afterwards the existing pool is kept
+            pass
+
+
+def _example_inputs(tokenizer):
+    inputs = tokenizer(["convert a list to a dict", "read a json file"], padding=True, return_tensors="pt")
+    return inputs["input_ids"], inputs["attention_mask"]
+
+
+def export_torchscript(model_path: str, file_path: str, tokenizer=None):
+    tokenizer = tokenizer or RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+    encoder = RobertaModel.from_pretrained(pretrained_model_name_or_path=model_path, torchscript=True)
+    graph = QueryGraph(Model(encoder)).eval()
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(graph, _example_inputs(tokenizer)))
+    torch.jit.save(traced, file_path, _extra_files={"fingerprint": model_fingerprint(model_path)})
+
+
+def export_onnx(model_path: str, file_path: str, tokenizer=None, opset_version: int = 14):
+    import onnx
+
+    tokenizer = tokenizer or RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+    encoder = RobertaModel.from_pretrained(pretrained_model_name_or_path=model_path, torchscript=True)
+    graph = QueryGraph(Model(encoder)).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            graph,
+            _example_inputs(tokenizer),
+            file_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["query_vecs"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "query_vecs": {0: "batch"},
+            },
+            opset_version=opset_version,
+        )
+    # Large weights may be stored next to the graph, only the graph itself is rewritten
+    exported = onnx.load(file_path, load_external_data=False)
+    exported.metadata_props.add(key="fingerprint", value=model_fingerprint(model_path))
+    onnx.save(exported, file_path)
+
+
+class TorchScriptQueryModel:
+    """
+    Loads an exported TorchScript graph, called like Model(nl_inputs=..., attention_mask=...)
+    """
+
+    def __init__(self, file_path: str, fingerprint: str = None):
+        extra_files = {"fingerprint": ""}
+        self.graph = torch.jit.load(file_path, map_location="cpu", _extra_files=extra_files)
+        exported_fingerprint = extra_files["fingerprint"]
+        if isinstance(exported_fingerprint, bytes):
+            exported_fingerprint = exported_fingerprint.decode("UTF-8")
+        self.fingerprint = exported_fingerprint
+        _check_fingerprint(file_path, self.fingerprint, fingerprint)
+
+    def __call__(self, nl_inputs=None, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = nl_inputs.ne(1)
+        with torch.inference_mode():
+            return self.graph(nl_inputs, attention_mask.long())
+
+
+class OnnxQueryModel:
+    """
+    Runs an exported ONNX graph with onnxruntime, called like Model(nl_inputs=..., attention_mask=...)
+    """
+
+    def __init__(
+        self, file_path: str, fingerprint: str = None, intra_op_threads: int = None, inter_op_threads: int = None
+    ):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads is not None:
+            options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(file_path, options, providers=["CPUExecutionProvider"])
+        self.fingerprint = self.session.get_modelmeta().custom_metadata_map.get("fingerprint", "")
+        _check_fingerprint(file_path, self.fingerprint, fingerprint)
+
+    def __call__(self, nl_inputs=None, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = nl_inputs.ne(1)
+        query_vecs, = self.session.run(
+            None, {"input_ids": nl_inputs.numpy(), "attention_mask": attention_mask.long().numpy()}
+        )
+        return torch.from_numpy(query_vecs)
+
+
+def _check_fingerprint(file_path: str, exported: str, expected: str):
+    if expected is not None and exported != expected:
+        raise ValueError("Exported model {} was created from a different model, export it again".format(file_path))
+
+
+def load_query_model(
+    runtime: str, file_path: str, fingerprint: str = None, intra_op_threads: int = None, inter_op_threads: int = None
+):
+    if runtime == "torchscript":
+        configure_threads(intra_op_threads, inter_op_threads)
+        return TorchScriptQueryModel(file_path, fingerprint=fingerprint)
+    elif runtime == "onnx":
+        return OnnxQueryModel(
+            file_path, fingerprint=fingerprint, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads
+        )
+    raise ValueError("Unknown runtime {}, expected torchscript or onnx".format(runtime))
+
+
+def default_export_path(runtime: str) -> str:
+    # Next to the embedding store, a file inside the model directory would change the model fingerprint
+    return "./query_encoder.pt" if runtime == "torchscript" else "./query_encoder.onnx"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the query encoder to TorchScript or ONNX")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--runtime", choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument("--output", default=None, help="Default: ./query_encoder.pt or ./query_encoder.onnx")
+    args = parser.parse_args()
+
+    output = args.output or default_export_path(args.runtime)
+    if args.runtime == "torchscript":
+        export_torchscript(args.model_path, output)
+    else:
+        export_onnx(args.model_path, output)
+    print("Exported {} query encoder to {}".format(args.runtime, output))
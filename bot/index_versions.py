@@ -0,0 +1,268 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from code_search import CodeSearch, RobertaCodeSearch
+from near_duplicates import duplicates_path
+
+"""
+Versioned code search indexes which are swapped without restarting the app or reloading the model.
+
+Every version is a directory below the index root which holds the corpus and its embeddings, together with the
+indexes built from them:
+
+    indexes/
+        CURRENT                 name of the live version
+        2022-06-01/
+            codebase.jsonl
+            embeddings.store    (or embeddings.npy, converted on the first load)
+            ...
+
+VersionedCodeSearch loads a newly published version in the background and warms it up, then flips the reference to
+it. Queries which already started keep the version they acquired, the old version is closed once the last of them has
+finished.
+"""
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+WARMUP_QUERIES = ["read a json file", "sort a list of dictionaries by a key", "create a dataframe"]
+
+
+def read_current(index_root: str) -> Optional[str]:
+    current_path = os.path.join(index_root, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as f:
+        return f.read().strip() or None
+
+
+def publish(index_root: str, version: str):
+    # The pointer file is replaced atomically, readers see either the old or the new version
+    if not os.path.isdir(os.path.join(index_root, version)):
+        raise ValueError("Index version {} does not exist in {}".format(version, index_root))
+    tmp_path = os.path.join(index_root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(index_root, CURRENT_FILE))
+
+
+def create_version(index_root: str, version: str, corpus_path: str, embeddings_path: str) -> str:
+    # Files are copied into the version directory, a hard link would share the inode with a source which is later
+    # rewritten in place. The directory appears once it is complete.
+    version_dir = os.path.join(index_root, version)
+    if os.path.exists(version_dir):
+        raise ValueError("Index version {} already exists in {}".format(version, index_root))
+    tmp_dir = version_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    embeddings_name = "embeddings.npy" if embeddings_path.endswith(".npy") else "embeddings.store"
+    files = [(corpus_path, "codebase.jsonl"), (embeddings_path, embeddings_name)]
+    if os.path.exists(duplicates_path(corpus_path)):
+        files.append((duplicates_path(corpus_path), duplicates_path("codebase.jsonl")))
+    for source, name in files:
+        shutil.copyfile(source, os.path.join(tmp_dir, name))
+    os.replace(tmp_dir, version_dir)
+    return version_dir
+
+
+def version_paths(version_dir: str) -> dict:
+    # Every file of a version lives in its directory, the indexes built on the first load included
+    paths = {
+        "codebase_file": os.path.join(version_dir, "codebase.jsonl"),
+        "embeddings_file": os.path.join(version_dir, "embeddings.npy"),
+        "embedding_store_file": os.path.join(version_dir, "embeddings.store"),
+        "ann_index_file": os.path.join(version_dir, "embeddings.ivf.npz"),
+        "bm25_index_file": os.path.join(version_dir, "codebase.bm25.npz"),
+        "metadata_index_file": os.path.join(version_dir, "codebase.meta.npz"),
+    }
+    # Only a deduplicated corpus comes with a duplicate map
+    if os.path.exists(duplicates_path(paths["codebase_file"])):
+        paths["duplicates_file"] = duplicates_path(paths["codebase_file"])
+    return paths
+
+
+class IndexVersion:
+    def __init__(self, name: str, code_search: RobertaCodeSearch):
+        self.name = name
+        self.code_search = code_search
+        self.in_flight = 0
+        self.retired = False
+        self.closed = False
+
+
+class VersionedCodeSearch(CodeSearch):
+    def __init__(
+        self,
+        index_root: str = "./indexes",
+        model_path: str = "python_model/",
+        poll_seconds: float = None,
+        **search_options
+    ):
+        # search_options are passed on to RobertaCodeSearch, e.g. use_ann_index=True or quantization="sq8"
+        self.index_root = index_root
+        self.model_path = model_path
+        self.search_options = search_options
+        self._lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        self._model = None
+        self._query_encoder = None
+        # A version which failed to load is not retried by refresh until another one is published
+        self._failed_version = None
+
+        version = read_current(index_root)
+        if version is None:
+            raise ValueError("No index version is published in {}".format(index_root))
+        self._current = self._load(version)
+
+        self._stop = threading.Event()
+        self._watcher = None
+        if poll_seconds is not None:
+            self._watcher = threading.Thread(target=self._watch, args=(poll_seconds,), daemon=True)
+            self._watcher.start()
+
+    @property
+    def version(self) -> str:
+        return self._current.name
+
+    def _load(self, version: str) -> IndexVersion:
+        version_dir = os.path.join(self.index_root, version)
+        options = dict(self.search_options)
+        options.update(version_paths(version_dir))
+        if "quantization" in options and options["quantization"] is not None:
+            options["quantized_file"] = os.path.join(version_dir, "embeddings.{}.npz".format(options["quantization"]))
+        # Only the first version loads the model, all later versions share it and its query encoder, which keeps the
+        # fingerprint of the loaded checkpoint even if model_path is replaced later
+        code_search = RobertaCodeSearch(
+            model_path=self.model_path, model=self._model, query_encoder=self._query_encoder, **options
+        )
+        self._model = code_search.model
+        self._query_encoder = code_search.query_encoder
+        return IndexVersion(version, code_search)
+
+    def _warm(self, index_version: IndexVersion):
+        # Reads the vectors once so that their pages are cached, then runs a few queries through every index
+        vectors = index_version.code_search.vecs
+        for start in range(0, len(vectors), 65536):
+            np.asarray(vectors[start:start + 65536], dtype=np.float32).sum()
+        index_version.code_search.find_code_for_queries(WARMUP_QUERIES, k=10)
+
+    def swap(self, version: str):
+        # Loading and warming happen before the flip, queries are served by the old version in the meantime
+        with self._swap_lock:
+            if version == self._current.name:
+                return
+            start = time.perf_counter()
+            new_version = self._load(version)
+            try:
+                self._warm(new_version)
+            except Exception:
+                # A version which fails its warmup is never served, its files are released right away
+                self._close(new_version)
+                raise
+            with self._lock:
+                old_version = self._current
+                self._current = new_version
+                old_version.retired = True
+                drained = old_version.in_flight == 0
+            if drained:
+                self._close(old_version)
+            logger.info("Swapped index %s for %s in %.1fs", old_version.name, version, time.perf_counter() - start)
+
+    def swap_in_background(self, version: str) -> threading.Thread:
+        thread = threading.Thread(target=self._swap_logged, args=(version,), daemon=True)
+        thread.start()
+        return thread
+
+    def _swap_logged(self, version: str):
+        try:
+            self.swap(version)
+        except Exception:
+            # A broken version must not take down the live one
+            self._failed_version = version
+            logger.exception("Could not load index version %s, keeping %s", version, self._current.name)
+
+    def refresh(self):
+        # Swaps to the published version if it changed
+        version = read_current(self.index_root)
+        if version is not None and version not in (self._current.name, self._failed_version):
+            self._swap_logged(version)
+
+    def _watch(self, poll_seconds: float):
+        while not self._stop.wait(poll_seconds):
+            self.refresh()
+
+    def _acquire(self) -> IndexVersion:
+        with self._lock:
+            index_version = self._current
+            index_version.in_flight += 1
+            return index_version
+
+    def _release(self, index_version: IndexVersion):
+        with self._lock:
+            index_version.in_flight -= 1
+            drained = index_version.retired and index_version.in_flight == 0
+        if drained:
+            self._close(index_version)
+
+    def _close(self, index_version: IndexVersion):
+        with self._lock:
+            if index_version.closed:
+                return
+            index_version.closed = True
+        index_version.code_search.close()
+        logger.info("Released index version %s", index_version.name)
+
+    def find_code_for_queries(
+        self, queries: List[str], k: int = 1, filter_expression: str = None
+    ) -> List[List[Tuple[int, float, str]]]:
+        index_version = self._acquire()
+        try:
+            return index_version.code_search.find_code_for_queries(queries, k=k, filter_expression=filter_expression)
+        finally:
+            self._release(index_version)
+
+    def find_code_for_query_topk(
+        self, query: str, k: int, filter_expression: str = None
+    ) -> List[Tuple[int, float, str]]:
+        return self.find_code_for_queries([query], k=k, filter_expression=filter_expression)[0]
+
+    def cache_stats(self) -> dict:
+        # The result cache belongs to the live version, it starts empty after every swap
+        return self._current.code_search.cache_stats()
+
+    def close(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create and publish versions of the code search index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create_parser = subparsers.add_parser("create", help="Create a version from a corpus and its embeddings")
+    create_parser.add_argument("index_root")
+    create_parser.add_argument("version")
+    create_parser.add_argument("--corpus", default="codebase.jsonl")
+    create_parser.add_argument("--embeddings", default="embeddings.store", help="An embedding store or .npy file")
+    create_parser.add_argument("--publish", action="store_true", help="Make the new version the live one")
+    publish_parser = subparsers.add_parser("publish", help="Make a version the live one")
+    publish_parser.add_argument("index_root")
+    publish_parser.add_argument("version")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        os.makedirs(args.index_root, exist_ok=True)
+        print("Created {}".format(create_version(args.index_root, args.version, args.corpus, args.embeddings)))
+    if args.command == "publish" or args.publish:
+        publish(args.index_root, args.version)
+        print("Published {}".format(args.version))
@@ -0,0 +1,171 @@
+import os
+import re
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+"""
+Posting lists over the metadata of the corpus records, so that a search can be restricted to e.g. one repository or
+module before any vector is scored. Every field keeps its distinct values sorted, so an exact value and a prefix are
+both a binary search followed by the union of the posting lists of a contiguous range of values.
+
+Filter expressions are whitespace separated field:value terms which all have to match, a term matches any of its comma
+separated values and a leading "-" excludes the matching records:
+
+    repo:pandas-dev/pandas func:read_ -module:pandas.tests
+
+Matches are combined as packed bitmasks with one bit per record.
+"""
+
+FIELDS = ("repo", "module", "path", "url", "func")
+# Fields which match a prefix of their values, module matches itself and its submodules
+_PREFIX_FIELDS = ("url", "func")
+_TERM_PATTERN = re.compile(r"^(-?)(\w+):(\S+)$")
+
+
+def parse_filter(expression: str) -> List[Tuple[bool, str, List[str]]]:
+    # Negation, field and values of every term, invalid terms and unknown fields raise a ValueError
+    terms = []
+    for term in expression.split():
+        term_match = _TERM_PATTERN.match(term)
+        if term_match is None:
+            raise ValueError("Invalid filter term {}, expected field:value".format(term))
+        negate, field, values = term_match.groups()
+        if field not in FIELDS:
+            raise ValueError("Unknown filter field {}, expected one of {}".format(field, FIELDS))
+        terms.append((negate == "-", field, values.split(",")))
+    return terms
+
+
+def record_metadata(js: dict) -> Dict[str, str]:
+    path = js.get("path", "")
+    if path == "" and "url" in js:
+        # CodeSearchNet urls look like https://github.com/<owner>/<repo>/blob/<sha>/<path>#L<start>-L<end>
+        parts = js["url"].split("#")[0].split("/")
+        path = "/".join(parts[7:]) if len(parts) > 7 else ""
+    module = path[:-3] if path.endswith(".py") else path
+    return {
+        "repo": js.get("repo", ""),
+        "module": module.replace("/", "."),
+        "path": path,
+        "url": js.get("url", ""),
+        "func": js.get("func_name", ""),
+    }
+
+
+class MetadataIndex:
+    def __init__(
+        self, n_records: int, values: Dict[str, np.ndarray], offsets: Dict[str, np.ndarray], rows: Dict[str, np.ndarray]
+    ):
+        self.n_records = n_records
+        # The records with the i-th value of a field are rows[field][offsets[field][i]:offsets[field][i + 1]]
+        self.values = values
+        self.offsets = offsets
+        self.rows = rows
+        # Identity of the corpus the index was built from
+        self.source = ""
+
+    def __len__(self):
+        return self.n_records
+
+    @classmethod
+    def build(cls, records: Iterable[dict]) -> "MetadataIndex":
+        field_values = {field: [] for field in FIELDS}
+        n_records = 0
+        for js in records:
+            for field, value in record_metadata(js).items():
+                field_values[field].append(value)
+            n_records += 1
+
+        values, offsets, rows = {}, {}, {}
+        for field in FIELDS:
+            distinct, inverse = np.unique(np.array(field_values[field], dtype=str), return_inverse=True)
+            order = np.argsort(inverse, kind="stable")
+            values[field] = distinct
+            offsets[field] = np.zeros(len(distinct) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(inverse, minlength=len(distinct)), out=offsets[field][1:])
+            rows[field] = order.astype(np.int32)
+        return cls(n_records, values, offsets, rows)
+
+    def save(self, file_path: str):
+        arrays = {"n_records": np.array(self.n_records), "source": np.array(self.source)}
+        for field in FIELDS:
+            arrays[field + "_values"] = self.values[field]
+            arrays[field + "_offsets"] = self.offsets[field]
+            arrays[field + "_rows"] = self.rows[field]
+        # Written next to the target and moved into place, other workers never load a partly written index
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> "MetadataIndex":
+        with np.load(file_path) as data:
+            metadata_index = cls(
+                int(data["n_records"]),
+                {field: data[field + "_values"] for field in FIELDS},
+                {field: data[field + "_offsets"] for field in FIELDS},
+                {field: data[field + "_rows"] for field in FIELDS},
+            )
+            metadata_index.source = str(data["source"]) if "source" in data.files else ""
+            return metadata_index
+
+    def _value_range(self, field: str, prefix: str, exact: bool):
+        # Sorted values with an exact value or a common prefix form one contiguous range
+        values = self.values[field]
+        start = np.searchsorted(values, prefix, side="left")
+        end = np.searchsorted(values, prefix if exact else prefix + "\uffff", side="right")
+        return int(start), int(end)
+
+    def _add_rows(self, mask: np.ndarray, field: str, value_range):
+        start, end = value_range
+        mask[self.rows[field][self.offsets[field][start]:self.offsets[field][end]]] = True
+
+    def match(self, field: str, value: str) -> np.ndarray:
+        # Packed bitmask of the records whose field has the value (or starts with it for prefix fields)
+        if field not in FIELDS:
+            raise ValueError("Unknown filter field {}, expected one of {}".format(field, FIELDS))
+        mask = np.zeros(self.n_records, dtype=bool)
+        self._add_rows(mask, field, self._value_range(field, value, exact=field not in _PREFIX_FIELDS))
+        if field == "module":
+            self._add_rows(mask, field, self._value_range(field, value + ".", exact=False))
+        return np.packbits(mask)
+
+    def filter(self, expression: str) -> np.ndarray:
+        # Packed bitmask of the records which match every term of the expression
+        result = np.packbits(np.ones(self.n_records, dtype=bool))
+        for negate, field, values in parse_filter(expression):
+            term_mask = np.zeros_like(result)
+            for value in values:
+                term_mask |= self.match(field, value)
+            result &= ~term_mask if negate else term_mask
+        return result
+
+    def rows_of(self, mask: np.ndarray) -> np.ndarray:
+        # Sorted rows of a packed bitmask, the padding bits of the last byte are cut off
+        return np.flatnonzero(np.unpackbits(mask, count=self.n_records))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from record_store import RecordStore
+
+    parser = argparse.ArgumentParser(description="Build the metadata index of a jsonl corpus")
+    parser.add_argument("corpus_path")
+    parser.add_argument("index_path")
+    parser.add_argument("--filter", nargs="*", default=[], help="Filter expressions to print the number of matches for")
+    args = parser.parse_args()
+
+    build_start = time.perf_counter()
+    corpus = RecordStore(args.corpus_path)
+    metadata_index = MetadataIndex.build(corpus)
+    metadata_index.source = corpus.identity
+    print("Indexed {} records in {:.1f}s".format(len(metadata_index), time.perf_counter() - build_start))
+    metadata_index.save(args.index_path)
+    for expression in args.filter:
+        filter_start = time.perf_counter()
+        n_matches = len(metadata_index.rows_of(metadata_index.filter(expression)))
+        print("{}: {} records ({:.2f}ms)".format(expression, n_matches, 1000 * (time.perf_counter() - filter_start)))
@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import numpy as np
+
+"""
+Micro-batching in front of the query encoder. Concurrent requests each submit their queries, a single worker thread
+collects them for at most max_wait_ms or until max_batch_size queries are waiting, encodes them in one padded forward
+pass and resolves the future of every caller with its own row of the result.
+"""
+
+
+class MicroBatcher:
+    def __init__(
+        self, encode_fn: Callable[[List[str]], np.ndarray], max_batch_size: int = 32, max_wait_ms: float = 5.0
+    ):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.n_batches = 0
+        self.n_queries = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="query-micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, query: str) -> Future:
+        if self._closed:
+            raise RuntimeError("The micro-batcher is closed")
+        future = Future()
+        self._queue.put((query, future))
+        return future
+
+    def encode(self, queries: List[str]) -> np.ndarray:
+        futures = [self.submit(query) for query in queries]
+        return np.stack([future.result() for future in futures])
+
+    def _collect(self) -> List:
+        # Blocks for the first query, afterwards waits at most max_wait_ms for the batch to fill up
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size and batch[-1] is not None:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            closing = batch[-1] is None
+            requests = [request for request in batch if request is not None]
+            if len(requests) > 0:
+                self._encode_batch(requests)
+            if closing:
+                return
+
+    def _encode_batch(self, requests: List):
+        try:
+            query_vecs = self.encode_fn([query for query, _ in requests])
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        self.n_batches += 1
+        self.n_queries += len(requests)
+        for (_, future), query_vec in zip(requests, query_vecs):
+            future.set_result(query_vec)
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.n_batches,
+            "queries": self.n_queries,
+            "mean_batch_size": self.n_queries / self.n_batches if self.n_batches > 0 else 0.0,
+        }
+
+    def close(self):
+        # Queries which were submitted before are still encoded
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._worker.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+
+    from transformers import RobertaTokenizerFast, RobertaModel
+
+    from codebert_model import Model, QueryEncoder
+
+    parser = argparse.ArgumentParser(description="Throughput of concurrent queries with and without micro-batching")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--n-queries", type=int, default=512)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    tokenizer = RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+    model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=args.model_path)).eval()
+    words = ["read", "write", "json", "file", "sort", "list", "dict", "parse", "url", "merge", "dataframe", "path"]
+    rng = np.random.default_rng(0)
+    queries = [" ".join(rng.choice(words, rng.integers(2, 8))) for _ in range(args.n_queries)]
+
+    for micro_batching in (False, True):
+        encoder = QueryEncoder(tokenizer, model)
+        if micro_batching:
+            encoder.enable_micro_batching(max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+        latencies = []
+
+        def request(query):
+            start = time.perf_counter()
+            encoder.encode([query])
+            latencies.append(1000 * (time.perf_counter() - start))
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(request, queries))
+        elapsed = time.perf_counter() - start_time
+        print("micro-batching={} qps={:.1f} p50={:.1f}ms p99={:.1f}ms {}".format(
+            micro_batching, len(queries) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99),
+            encoder.micro_batcher.stats() if micro_batching else "",
+        ))
+        if micro_batching:
+            encoder.micro_batcher.close()
@@ -0,0 +1,215 @@
+import os
+import time
+import zlib
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from record_store import RecordStore
+
+"""
+Collapses near-duplicate functions of a jsonl corpus before it is embedded. Every record is reduced to a MinHash
+signature of the token n-grams of its code_tokens, locality sensitive hashing over bands of the signatures finds the
+candidate pairs and a candidate is a duplicate if the estimated Jaccard similarity of the pair reaches the threshold.
+
+Every cluster keeps its first record as representative, the deduplicated corpus holds the representatives in corpus
+order. Next to it a DuplicateMap maps each of its rows back to the rows and urls of the collapsed duplicates.
+"""
+
+# Mersenne prime 2^31 - 1, a * x + b stays below 2^63 for 31 bit hashes and coefficients
+_PRIME = np.uint64((1 << 31) - 1)
+# Signature value of a record without any shingle, it never collides because such records are not hashed into bands
+_EMPTY = np.uint32(0xFFFFFFFF)
+
+
+def duplicates_path(corpus_path: str) -> str:
+    return corpus_path + ".duplicates.npz"
+
+
+def shingles(code_tokens: List[str], n: int = 5) -> np.ndarray:
+    # 31 bit hashes of the distinct token n-grams, functions shorter than n tokens are a single shingle
+    if len(code_tokens) == 0:
+        return np.empty(0, dtype=np.uint64)
+    n = min(n, len(code_tokens))
+    grams = {" ".join(code_tokens[i:i + n]) for i in range(len(code_tokens) - n + 1)}
+    return np.fromiter((zlib.crc32(gram.encode("UTF-8")) for gram in grams), dtype=np.uint64, count=len(grams)) % _PRIME
+
+
+class MinHasher:
+    def __init__(self, n_permutations: int = 128, shingle_size: int = 5, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        # Universal hash functions (a * x + b) mod p stand in for random permutations of the shingles
+        self.a = rng.integers(1, int(_PRIME), size=(n_permutations, 1), dtype=np.uint64)
+        self.b = rng.integers(0, int(_PRIME), size=(n_permutations, 1), dtype=np.uint64)
+        self.shingle_size = shingle_size
+
+    @property
+    def n_permutations(self) -> int:
+        return len(self.a)
+
+    def signature(self, code_tokens: List[str]) -> np.ndarray:
+        hashes = shingles(code_tokens, self.shingle_size)
+        if len(hashes) == 0:
+            return np.full(self.n_permutations, _EMPTY, dtype=np.uint32)
+        return ((self.a * hashes[None, :] + self.b) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def signatures(self, records: Iterable[dict]) -> np.ndarray:
+        return np.stack([self.signature(js["code_tokens"]) for js in records])
+
+
+def _find(parents: np.ndarray, i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def cluster_signatures(signatures: np.ndarray, threshold: float = 0.85, n_bands: int = 16) -> np.ndarray:
+    """
+    Returns the cluster of every row as the row of its representative, which is the first row of the cluster.
+
+    Rows whose signatures agree on all values of at least one band are candidates, with 16 bands of 8 values a pair
+    with Jaccard similarity 0.85 is a candidate with probability 0.99 and one with 0.5 with probability 0.06.
+    """
+    n_rows, n_permutations = signatures.shape
+    if n_permutations % n_bands != 0:
+        raise ValueError("{} permutations can not be split into {} bands".format(n_permutations, n_bands))
+    rows_per_band = n_permutations // n_bands
+    hashed = np.flatnonzero(signatures[:, 0] != _EMPTY)
+    parents = np.arange(n_rows)
+    for band in range(n_bands):
+        band_values = np.ascontiguousarray(signatures[hashed, band * rows_per_band:(band + 1) * rows_per_band])
+        # Every band becomes one opaque value, rows with equal values share a bucket
+        buckets = band_values.view(np.dtype((np.void, band_values.dtype.itemsize * rows_per_band))).ravel()
+        _, inverse, counts = np.unique(buckets, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        shared = counts[inverse] > 1
+        members = hashed[shared]
+        member_buckets = inverse[shared]
+        order = np.argsort(member_buckets, kind="stable")
+        members, member_buckets = members[order], member_buckets[order]
+        # Every member of a bucket is compared with the first member, which is its smallest row
+        first = np.ones(len(members), dtype=bool)
+        first[1:] = member_buckets[1:] != member_buckets[:-1]
+        heads = np.maximum.accumulate(np.where(first, np.arange(len(members)), 0))
+        candidates = np.flatnonzero(~first)
+        left, right = members[heads[candidates]], members[candidates]
+        similar = (signatures[left] == signatures[right]).mean(axis=1) >= threshold
+        for i, j in zip(left[similar].tolist(), right[similar].tolist()):
+            root_i, root_j = _find(parents, i), _find(parents, j)
+            if root_i != root_j:
+                # The smaller row stays the root, so the root of a cluster is its first record
+                parents[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([_find(parents, i) for i in range(n_rows)], dtype=np.int64)
+
+
+class DuplicateMap:
+    def __init__(self, rows: np.ndarray, offsets: np.ndarray, duplicate_rows: np.ndarray, duplicate_urls: np.ndarray):
+        # Row i of the deduplicated corpus is row rows[i] of the original corpus, its duplicates are
+        # duplicate_rows[offsets[i]:offsets[i + 1]] with the urls duplicate_urls[offsets[i]:offsets[i + 1]]
+        self.rows = rows
+        self.offsets = offsets
+        self.duplicate_rows = duplicate_rows
+        self.duplicate_urls = duplicate_urls
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def n_duplicates(self) -> int:
+        return len(self.duplicate_rows)
+
+    @classmethod
+    def from_clusters(cls, clusters: np.ndarray, urls: List[str]) -> "DuplicateMap":
+        rows = np.flatnonzero(clusters == np.arange(len(clusters)))
+        duplicates = np.flatnonzero(clusters != np.arange(len(clusters)))
+        # Duplicates are grouped by the deduplicated row of their representative, within a group in corpus order
+        duplicate_groups = np.searchsorted(rows, clusters[duplicates])
+        order = np.argsort(duplicate_groups, kind="stable")
+        duplicates = duplicates[order]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(duplicate_groups, minlength=len(rows)), out=offsets[1:])
+        return cls(rows, offsets, duplicates, np.array([urls[i] for i in duplicates.tolist()], dtype=str))
+
+    def save(self, file_path: str):
+        # Written next to the target and moved into place, readers of the old map never see a partly written file
+        tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                rows=self.rows,
+                offsets=self.offsets,
+                duplicate_rows=self.duplicate_rows,
+                duplicate_urls=self.duplicate_urls,
+            )
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> "DuplicateMap":
+        with np.load(file_path) as data:
+            return cls(data["rows"], data["offsets"], data["duplicate_rows"], data["duplicate_urls"])
+
+    def original_row(self, row: int) -> int:
+        return int(self.rows[row])
+
+    def duplicates_of(self, row: int) -> List[Tuple[int, str]]:
+        # Original rows and urls of the records which were collapsed into a row of the deduplicated corpus
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return list(zip(self.duplicate_rows[start:end].tolist(), self.duplicate_urls[start:end].tolist()))
+
+
+def deduplicate_corpus(
+    corpus_path: str,
+    output_path: str,
+    threshold: float = 0.85,
+    n_permutations: int = 128,
+    n_bands: int = 16,
+    shingle_size: int = 5,
+) -> DuplicateMap:
+    # Writes the representatives to output_path and the map back to their duplicates next to it
+    records = RecordStore(corpus_path)
+    hasher = MinHasher(n_permutations=n_permutations, shingle_size=shingle_size)
+    signatures = np.empty((len(records), n_permutations), dtype=np.uint32)
+    urls = []
+    for i, js in enumerate(records):
+        signatures[i] = hasher.signature(js["code_tokens"])
+        urls.append(js.get("url", ""))
+    duplicate_map = DuplicateMap.from_clusters(cluster_signatures(signatures, threshold, n_bands), urls)
+
+    # Kept records are copied byte for byte into a new file, a record store open on the old output keeps its offsets
+    tmp_path = "{}.{}.tmp".format(output_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        for row in duplicate_map.rows.tolist():
+            raw = records.read_raw(row)
+            f.write(raw if raw.endswith(b"\n") else raw + b"\n")
+    os.replace(tmp_path, output_path)
+    duplicate_map.save(duplicates_path(output_path))
+    return duplicate_map
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Collapse the near-duplicate functions of a jsonl corpus")
+    parser.add_argument("corpus_path")
+    parser.add_argument("output_path", help="Deduplicated corpus, the duplicate map is written next to it")
+    parser.add_argument("--threshold", type=float, default=0.85, help="Estimated Jaccard similarity of duplicates")
+    parser.add_argument("--permutations", type=int, default=128)
+    parser.add_argument("--bands", type=int, default=16)
+    parser.add_argument("--shingle-size", type=int, default=5, help="Number of code tokens per shingle")
+    args = parser.parse_args()
+
+    dedup_start = time.perf_counter()
+    result = deduplicate_corpus(
+        args.corpus_path,
+        args.output_path,
+        threshold=args.threshold,
+        n_permutations=args.permutations,
+        n_bands=args.bands,
+        shingle_size=args.shingle_size,
+    )
+    n_total = len(result) + result.n_duplicates
+    print("Kept {} of {} records, collapsed {} duplicates ({:.1%}) in {:.1f}s".format(
+        len(result), n_total, result.n_duplicates, result.n_duplicates / max(n_total, 1),
+        time.perf_counter() - dedup_start
+    ))
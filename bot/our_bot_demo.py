@@ -1,3 +1,5 @@
+from typing import Optional
+
 from dialogue_bot.bot_env import BotEnv
 from dialogue_bot.bot_session import BotSession
 from dialogue_bot.models.intent import Intent
@@ -5,25 +7,37 @@ from dialogue_bot.models.inputs.nl import NLInput
 from dialogue_bot.models.triggers.nl import AnyNLTrigger, FallbackNLTrigger
 from dialogue_bot.models.entity import Entity
 
-from fastapi import FastAPI
-from pydantic import BaseModel
-from response_generator import CodeSearchResponseGenerator, FunctionExplainerResponseGenerator
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel, conint
+from response_generator import CodeSearchInput, CodeSearchResponseGenerator, FunctionExplainerResponseGenerator
 from response_generator_action import ResponseGeneratorAction
+from index_versions import VersionedCodeSearch
 from function_explainer import FunctionExplainer
+from metadata_index import parse_filter
 
 
 class ChatInput(BaseModel):
     user_input: str
 
 
+# Upper bound of k, a response holds the code of every result
+MAX_RESULTS = 100
+
+
+class CodeSearchChatInput(ChatInput):
+    k: conint(ge=1, le=MAX_RESULTS) = 1
+    filter: Optional[str] = None
+
+
 function_explainer = FunctionExplainer()
 
 # CODE SEARCH BOT
 code_search_bot = BotEnv("code_search_bot", "en")
 
+code_search_response_generator = CodeSearchResponseGenerator(function_explainer)
 code_search_response_action = ResponseGeneratorAction(
     "code-search-response",
-    CodeSearchResponseGenerator(function_explainer)
+    code_search_response_generator
 )
 code_search_response_intent = Intent(
     code_search_bot, "code-search-intent",
@@ -33,7 +47,6 @@ code_search_response_intent = Intent(
 code_search_bot.register_intent(code_search_response_intent)
 
 code_search_bot.start(True)
-code_search_session = BotSession(code_search_bot)
 
 # FUNCTION EXPLAINER BOT
 function_explainer_bot = BotEnv("function_explainer_bot", "en")
@@ -79,11 +92,40 @@ app = FastAPI()
 
 
 @app.post("/code-search")
-def code_search_chat(chat_input: ChatInput):
+def code_search_chat(chat_input: CodeSearchChatInput):
+    # An invalid filter is rejected before the bot runs, an exception inside the bot would leave the session broken
+    if chat_input.filter is not None:
+        try:
+            parse_filter(chat_input.filter)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    code_search_input = CodeSearchInput(chat_input.user_input, k=chat_input.k, filter_expression=chat_input.filter)
+    # Every request gets its own session, the results are passed back through the session's input and concurrent
+    # requests on a shared session would see each other's input
     code_search_bot.respond(
-        code_search_session,
-        NLInput(chat_input.user_input)
+        BotSession(code_search_bot),
+        code_search_input
     )
+    return [
+        {"index": index, "score": score, "code": code}
+        for index, score, code in code_search_input.results
+    ]
+
+
+@app.get("/code-search/stats")
+def code_search_stats():
+    # Hit rates of the query embedding cache and of the semantic result cache
+    return code_search_response_generator.code_search.cache_stats()
+
+
+@app.post("/code-search/refresh")
+def code_search_refresh():
+    # Loads a newly published index version right away instead of waiting for the next poll
+    code_search = code_search_response_generator.code_search
+    if not isinstance(code_search, VersionedCodeSearch):
+        raise HTTPException(status_code=409, detail="The code search does not serve versioned indexes")
+    code_search.refresh()
+    return {"version": code_search.version}
 
 
 @app.post("/function-explanation")
@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from codebert_model import CodeEncoder
+from record_store import RecordStore
+from text_dataset import LengthBucketBatchSampler, convert_examples_to_features
+
+"""
+Compares fixed padding (256 code tokens per snippet) with length bucketed dynamic padding. Reports real and padded
+tokens for the embedding build and for fine-tuning batches, together with the wall-clock time of encoding.
+"""
+
+
+def encode_fixed_padding(encoder: CodeEncoder, records) -> np.ndarray:
+    code_vecs = []
+    for start in range(0, len(records), encoder.batch_size):
+        features = [convert_examples_to_features(js, encoder.tokenizer) for js in records[start:start + encoder.batch_size]]
+        with torch.no_grad():
+            code_vecs.append(encoder.model(code_inputs=torch.tensor([f.code_ids for f in features])).numpy())
+    return np.vstack(code_vecs)
+
+
+def padded_tokens(lengths, batches) -> int:
+    return sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("corpus_path")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--n-records", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    corpus = RecordStore(args.corpus_path)
+    records = [corpus[i] for i in range(min(args.n_records, len(corpus)))]
+    code_encoder = CodeEncoder.from_pretrained(args.model_path, batch_size=args.batch_size)
+    features = [convert_examples_to_features(js, code_encoder.tokenizer) for js in records]
+    code_lengths = [len(f.code_tokens) for f in features]
+    nl_lengths = [len(f.nl_tokens) for f in features]
+
+    start_time = time.perf_counter()
+    fixed_vecs = encode_fixed_padding(code_encoder, records)
+    fixed_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    bucketed_vecs = code_encoder.encode(records)
+    bucketed_seconds = time.perf_counter() - start_time
+
+    order = np.argsort(code_lengths, kind="stable")
+    build_batches = [order[i:i + args.batch_size] for i in range(0, len(order), args.batch_size)]
+    print("Embedding build of {} records".format(len(records)))
+    print("  real tokens:            {}".format(sum(code_lengths)))
+    print("  fixed padded tokens:    {} in {:.2f}s".format(len(records) * len(features[0].code_ids), fixed_seconds))
+    print("  bucketed padded tokens: {} in {:.2f}s".format(padded_tokens(code_lengths, build_batches), bucketed_seconds))
+    print("  max abs difference:     {:.2e}".format(float(np.abs(fixed_vecs - bucketed_vecs).max())))
+
+    training_batches = list(LengthBucketBatchSampler(code_lengths, args.batch_size, seed=0))
+    print("Fine-tuning batches")
+    print("  real code / nl tokens:            {} / {}".format(sum(code_lengths), sum(nl_lengths)))
+    print("  fixed padded code / nl tokens:    {} / {}".format(
+        len(records) * len(features[0].code_ids), len(records) * len(features[0].nl_ids)
+    ))
+    print("  bucketed padded code / nl tokens: {} / {}".format(
+        padded_tokens(code_lengths, training_batches), padded_tokens(nl_lengths, training_batches)
+    ))
@@ -0,0 +1,254 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Tuple
+
+import numpy as np
+
+from ann_index import kmeans
+from vector_search import top_k
+
+"""
+Compressed storage of the code embeddings. The compressed codes are scanned to find candidates which are re-ranked with
+the float vectors afterwards, so only the codes have to stay in memory while the float vectors are read from the mapped
+embedding store for the few re-ranked candidates.
+"""
+
+
+def save_arrays(file_path: str, **arrays):
+    # Written next to the target and moved into place, other workers never load partly written codes
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, file_path)
+
+
+class VectorQuantizer(ABC):
+    name = None
+    # Identity of the embedding store the codes were computed from
+    source = ""
+
+    @abstractmethod
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def scores(self, query_vec: np.ndarray) -> np.ndarray:
+        # Approximate inner products of the query with all encoded vectors
+        pass
+
+    @abstractmethod
+    def save(self, file_path: str):
+        pass
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def search(
+        self, query_vec: np.ndarray, k: int, vectors: np.ndarray, rerank_candidates: int = 100
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        query_vec = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+        candidates, _ = top_k(self.scores(query_vec), max(k, rerank_candidates))
+        candidates = np.sort(candidates)
+        positions, scores = top_k(np.asarray(vectors[candidates], dtype=np.float32) @ query_vec, k)
+        return candidates[positions], scores
+
+
+class ScalarQuantizer(VectorQuantizer):
+    """
+    8 bit quantization of every dimension between its minimum and maximum value (4x smaller than float32)
+    """
+
+    name = "sq8"
+
+    def __init__(self, minimum: np.ndarray, scale: np.ndarray, codes: np.ndarray = None):
+        self.minimum = minimum
+        self.scale = scale
+        self.codes = codes
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, chunk_size: int = 65536) -> "ScalarQuantizer":
+        minimum = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        maximum = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            minimum = np.minimum(minimum, chunk.min(axis=0))
+            maximum = np.maximum(maximum, chunk.max(axis=0))
+        scale = np.maximum(maximum - minimum, 1e-12) / 255
+        quantizer = cls(minimum, scale.astype(np.float32))
+        quantizer.codes = quantizer.encode(vectors, chunk_size=chunk_size)
+        return quantizer
+
+    def encode(self, vectors: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        codes = np.empty(vectors.shape, dtype=np.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = (np.asarray(vectors[start:start + chunk_size], dtype=np.float32) - self.minimum) / self.scale
+            codes[start:start + chunk_size] = np.clip(np.rint(chunk), 0, 255)
+        return codes
+
+    def scores(self, query_vec: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        # q . x = q . minimum + (q * scale) . code, the codes are widened in blocks to keep the scan cache friendly
+        offset = float(query_vec @ self.minimum)
+        scaled_query = query_vec * self.scale
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), chunk_size):
+            scores[start:start + chunk_size] = self.codes[start:start + chunk_size].astype(np.float32) @ scaled_query
+        return scores + offset
+
+    def save(self, file_path: str):
+        save_arrays(
+            file_path, kind=self.name, minimum=self.minimum, scale=self.scale, codes=self.codes, source=self.source
+        )
+
+
+class ProductQuantizer(VectorQuantizer):
+    """
+    Splits every vector into n_subspaces parts which are each replaced by the id of the closest of 256 centroids.
+    With 4 dimensions per subspace a 768 dimensional vector takes 192 bytes (16x smaller than float32).
+    """
+
+    name = "pq"
+
+    def __init__(self, codebooks: np.ndarray, codes: np.ndarray = None):
+        # codebooks has the shape (n_subspaces, 256, subspace_dim)
+        self.codebooks = codebooks
+        self.codes = codes
+
+    @property
+    def n_subspaces(self) -> int:
+        return self.codebooks.shape[0]
+
+    @classmethod
+    def train(
+        cls,
+        vectors: np.ndarray,
+        n_subspaces: int = None,
+        n_iter: int = 15,
+        max_training_points: int = 65536,
+        seed: int = 0,
+    ) -> "ProductQuantizer":
+        dim = vectors.shape[1]
+        if n_subspaces is None:
+            n_subspaces = dim // 4
+        if dim % n_subspaces != 0:
+            raise ValueError("Dimension {} is not divisible by {} subspaces".format(dim, n_subspaces))
+        subspace_dim = dim // n_subspaces
+        n_centroids = min(256, len(vectors))
+
+        rng = np.random.default_rng(seed)
+        training_ids = np.sort(rng.choice(len(vectors), min(len(vectors), max_training_points), replace=False))
+        training = np.asarray(vectors[training_ids], dtype=np.float32)
+        codebooks = np.zeros((n_subspaces, 256, subspace_dim), dtype=np.float32)
+        for j in range(n_subspaces):
+            subspace = training[:, j * subspace_dim:(j + 1) * subspace_dim]
+            codebooks[j, :n_centroids] = kmeans(subspace, n_centroids, n_iter=n_iter, seed=seed)
+        quantizer = cls(codebooks)
+        quantizer.codes = quantizer.encode(vectors)
+        return quantizer
+
+    def encode(self, vectors: np.ndarray, chunk_size: int = 16384) -> np.ndarray:
+        n_subspaces, _, subspace_dim = self.codebooks.shape
+        codebook_norms = (self.codebooks ** 2).sum(axis=2)
+        codes = np.empty((len(vectors), n_subspaces), dtype=np.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            for j in range(n_subspaces):
+                subspace = chunk[:, j * subspace_dim:(j + 1) * subspace_dim]
+                distances = codebook_norms[j][None, :] - 2 * subspace @ self.codebooks[j].T
+                codes[start:start + chunk_size, j] = distances.argmin(axis=1)
+        return codes
+
+    def scores(self, query_vec: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        # Asymmetric distance computation: a lookup table of the query part against every centroid is built once
+        # and the score of a vector is the sum of its n_subspaces table entries
+        n_subspaces, _, subspace_dim = self.codebooks.shape
+        lookup = np.einsum("jcd,jd->jc", self.codebooks, query_vec.reshape(n_subspaces, subspace_dim))
+        subspaces = np.arange(n_subspaces)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), chunk_size):
+            scores[start:start + chunk_size] = lookup[subspaces, self.codes[start:start + chunk_size]].sum(axis=1)
+        return scores
+
+    def save(self, file_path: str):
+        save_arrays(file_path, kind=self.name, codebooks=self.codebooks, codes=self.codes, source=self.source)
+
+
+def train_quantizer(kind: str, vectors: np.ndarray) -> VectorQuantizer:
+    if kind == ScalarQuantizer.name:
+        return ScalarQuantizer.train(vectors)
+    elif kind == ProductQuantizer.name:
+        return ProductQuantizer.train(vectors)
+    raise ValueError("Unknown quantization {}, expected sq8 or pq".format(kind))
+
+
+def load_quantizer(file_path: str) -> VectorQuantizer:
+    with np.load(file_path) as data:
+        kind = str(data["kind"])
+        if kind == ScalarQuantizer.name:
+            quantizer = ScalarQuantizer(data["minimum"], data["scale"], data["codes"])
+        elif kind == ProductQuantizer.name:
+            quantizer = ProductQuantizer(data["codebooks"], data["codes"])
+        else:
+            raise ValueError("Unknown quantization {} in {}".format(kind, file_path))
+        # Files written before the source was recorded have none and are never reused
+        quantizer.source = str(data["source"]) if "source" in data.files else ""
+        return quantizer
+
+
+def mrr_report(
+    quantizer: VectorQuantizer, vectors: np.ndarray, query_vecs: np.ndarray, k: int = 10, rerank_candidates: int = 100
+) -> Dict:
+    # MRR@k of the two stage search, where the relevant result of a query is its exhaustive float top-1
+    reciprocal_ranks = []
+    exhaustive_seconds = 0.0
+    quantized_seconds = 0.0
+    for query_vec in query_vecs:
+        start = time.perf_counter()
+        expected = top_k(vectors @ query_vec, 1)[0][0]
+        exhaustive_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        ids, _ = quantizer.search(query_vec, k, vectors, rerank_candidates=rerank_candidates)
+        quantized_seconds += time.perf_counter() - start
+        ranks = np.flatnonzero(ids == expected)
+        reciprocal_ranks.append(1 / (ranks[0] + 1) if len(ranks) > 0 else 0.0)
+    return {
+        "quantization": quantizer.name,
+        "mrr@{}".format(k): float(np.mean(reciprocal_ranks)),
+        "compression": vectors.nbytes / quantizer.nbytes,
+        "query_ms": 1000 * quantized_seconds / len(query_vecs),
+        "exhaustive_ms": 1000 * exhaustive_seconds / len(query_vecs),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from embedding_store import EmbeddingStore
+
+    parser = argparse.ArgumentParser(description="Quantize an embedding store and report the MRR loss")
+    parser.add_argument("store_path")
+    parser.add_argument("quantized_path")
+    parser.add_argument("--kind", choices=[ScalarQuantizer.name, ProductQuantizer.name], default="sq8")
+    parser.add_argument("--queries", default=None, help=".npy file with query embeddings, default: corpus sample")
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--rerank-candidates", type=int, nargs="+", default=[10, 50, 100])
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_path)
+    vector_quantizer = train_quantizer(args.kind, store.vectors)
+    vector_quantizer.source = store.identity
+    vector_quantizer.save(args.quantized_path)
+
+    if args.queries is not None:
+        queries = np.load(args.queries)
+    else:
+        query_ids = np.random.default_rng(0).choice(len(store), min(args.n_queries, len(store)), replace=False)
+        # Perturbed corpus vectors, otherwise every query would find itself
+        queries = np.asarray(store.vectors[np.sort(query_ids)], dtype=np.float32)
+        queries += np.random.default_rng(1).normal(scale=queries.std(), size=queries.shape).astype(np.float32)
+    for candidates in args.rerank_candidates:
+        row = mrr_report(vector_quantizer, store.vectors, queries, rerank_candidates=candidates)
+        row["rerank_candidates"] = candidates
+        print(row)
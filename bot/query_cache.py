@@ -0,0 +1,117 @@
+import atexit
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+"""
+Bounded LRU cache for query embeddings, so that recurring queries do not need another forward pass of the encoder
+"""
+
+
+def normalize_query(query: str) -> str:
+    # Only whitespace is normalized, the tokenizer is case sensitive and would produce different embeddings
+    return re.sub(r"\s+", " ", query).strip()
+
+
+class QueryEmbeddingCache:
+    def __init__(
+        self,
+        fingerprint: str,
+        max_size: int = 1024,
+        ttl_seconds: float = None,
+        persist_path: str = None,
+    ):
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        if persist_path is not None:
+            if os.path.exists(persist_path):
+                self.load()
+            atexit.register(self.save)
+
+    def _key(self, query: str) -> Tuple[str, str]:
+        return self.fingerprint, normalize_query(query)
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created > self.ttl_seconds
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        key = self._key(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0], time.time()):
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query: str, embedding: np.ndarray, created: float = None):
+        key = self._key(query)
+        with self._lock:
+            self._entries[key] = (time.time() if created is None else created, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def save(self):
+        with self._lock:
+            entries = [(key, entry) for key, entry in self._entries.items() if key[0] == self.fingerprint]
+        if len(entries) == 0:
+            return
+        # Every worker saves at exit, each writes its own temporary file and the last replace wins
+        tmp_path = "{}.{}.tmp".format(self.persist_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                fingerprint=self.fingerprint,
+                queries=np.array([key[1] for key, _ in entries]),
+                created=np.array([entry[0] for _, entry in entries], dtype=np.float64),
+                embeddings=np.stack([entry[1] for _, entry in entries]),
+            )
+        os.replace(tmp_path, self.persist_path)
+
+    def load(self):
+        with np.load(self.persist_path) as data:
+            # Embeddings of another model are useless, the cache starts empty in this case
+            if str(data["fingerprint"]) != self.fingerprint:
+                return
+            now = time.time()
+            # Entries are saved from least to most recently used, so the LRU order survives a restart
+            for query, created, embedding in zip(data["queries"], data["created"], data["embeddings"]):
+                if not self._expired(float(created), now):
+                    self.put(str(query), embedding, created=float(created))
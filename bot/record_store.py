@@ -0,0 +1,91 @@
+import json
+import os
+
+import numpy as np
+
+"""
+Read-only access to the records of a jsonl file by line number. A sidecar index with the byte offset of every line is
+built once, afterwards records are only read from disk when they are requested.
+
+The index file starts with the size and the modification time of the jsonl file it was built for, followed by the
+offsets.
+"""
+
+_IDENTITY_SIZE = 2
+
+
+def file_identity(file_path: str) -> np.ndarray:
+    # An edit which keeps the size of a file still changes its modification time
+    stat = os.stat(file_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.uint64)
+
+
+def build_offset_index(file_path: str) -> np.ndarray:
+    # offsets[i] is the start of record i, the last entry is the size of the file
+    offsets = [0]
+    position = 0
+    with open(file_path, "rb") as f:
+        for line in f:
+            position += len(line)
+            if line.strip():
+                offsets.append(position)
+            else:
+                # Empty lines are not records, move the start of the next record behind them
+                offsets[-1] = position
+    return np.asarray(offsets, dtype=np.uint64)
+
+
+class RecordStore:
+    def __init__(self, file_path: str, index_path: str = None):
+        self._fd = None
+        self.file_path = file_path
+        self.index_path = index_path if index_path is not None else file_path + ".idx.npy"
+        self.offsets = self._load_offsets()
+        self._fd = os.open(file_path, os.O_RDONLY)
+
+    def _load_offsets(self) -> np.ndarray:
+        identity = file_identity(self.file_path)
+        if os.path.exists(self.index_path):
+            index = np.load(self.index_path, mmap_mode="r")
+            if len(index) > _IDENTITY_SIZE and np.array_equal(index[:_IDENTITY_SIZE], identity):
+                return index[_IDENTITY_SIZE:]
+        # Index is missing or belongs to an older version of the file
+        index = np.concatenate([identity, build_offset_index(self.file_path)])
+        tmp_path = "{}.{}.tmp.npy".format(self.index_path, os.getpid())
+        np.save(tmp_path, index)
+        os.replace(tmp_path, self.index_path)
+        return np.load(self.index_path, mmap_mode="r")[_IDENTITY_SIZE:]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def identity(self) -> str:
+        # Indexes built from the records save this, so that they are rebuilt after the file changed
+        size, mtime_ns = file_identity(self.file_path).tolist()
+        return "{}:{}".format(size, mtime_ns)
+
+    def read_raw(self, i: int) -> bytes:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Record index {} out of range".format(i))
+        start = int(self.offsets[i])
+        end = int(self.offsets[i + 1])
+        # pread does not move a shared file position, so concurrent readers do not interfere
+        return os.pread(self._fd, end - start, start)
+
+    def __getitem__(self, i: int) -> dict:
+        return json.loads(self.read_raw(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
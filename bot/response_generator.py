@@ -3,9 +3,11 @@ import inspect
 
 from abc import ABC, abstractmethod
 from importlib import import_module
+from typing import List, Optional, Tuple
 
 from dialogue_bot.models.inputs.nl import UserInput, NLInput
 from code_search import CodeSearch, RobertaCodeSearch
+from index_versions import VersionedCodeSearch, read_current
 from function_explainer import FunctionExplainer, get_module_and_function
 
 
@@ -15,19 +17,51 @@ class ResponseGenerator(ABC):
         pass
 
 
+class CodeSearchInput(NLInput):
+    """
+    A code search query which asks for the k best results, optionally restricted by a metadata filter expression like
+    "repo:pandas-dev/pandas". The ranked results are stored on the input, so that the caller can return them next to
+    the bot's response.
+    """
+
+    def __init__(self, text: str, k: int = 1, filter_expression: Optional[str] = None):
+        super().__init__(text)
+        self.k = k
+        self.filter_expression = filter_expression
+        self.results: List[Tuple[int, float, str]] = []
+
+
 # IMPLEMENTATIONS
 
+# Versions of the index published below this directory are picked up without a restart, see index_versions.py
+INDEX_ROOT = "./indexes"
+INDEX_POLL_SECONDS = 30.0
+
+
 class CodeSearchResponseGenerator(ResponseGenerator):
     def __init__(self, function_explainer: FunctionExplainer):
-        self.code_search: CodeSearch = RobertaCodeSearch()
+        if read_current(INDEX_ROOT) is not None:
+            self.code_search: CodeSearch = VersionedCodeSearch(INDEX_ROOT, poll_seconds=INDEX_POLL_SECONDS)
+        else:
+            self.code_search: CodeSearch = RobertaCodeSearch()
         self.function_explainer = function_explainer
 
     def generate_response(self, user_input: UserInput) -> str:
         if isinstance(user_input, NLInput):
             input_text: str = user_input.text
-            code_search_result: str = self.code_search.find_code_for_query(input_text)
+            k = user_input.k if isinstance(user_input, CodeSearchInput) else 1
+            if isinstance(user_input, CodeSearchInput) and user_input.filter_expression is not None:
+                code_search_results = self.code_search.find_code_for_query_topk(
+                    input_text, k, filter_expression=user_input.filter_expression
+                )
+            else:
+                code_search_results = self.code_search.find_code_for_query_topk(input_text, k)
+            if isinstance(user_input, CodeSearchInput):
+                user_input.results = code_search_results
+            if len(code_search_results) == 0:
+                return "I could not find any code for this query."
             return self.function_explainer.explain_function(
-                source_code=code_search_result
+                source_code=code_search_results[0][2]
             )
         else:
             return "I don't understand this kind of input."
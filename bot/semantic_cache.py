@@ -0,0 +1,172 @@
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+"""
+Cache of ranked search results keyed by the query embedding instead of the query text, so that paraphrases like
+"create a dataframe" and "make a pandas dataframe" share one result. The embeddings of the cached queries are kept as
+unit vectors in a small matrix, a lookup is one matrix-vector product over it and hits if the most similar cached query
+reaches the cosine threshold.
+
+A result is only reused for the same context, e.g. the filter expression and the lexical terms of a hybrid search, and
+for a k which is at most the k it was computed for.
+
+The cache is lossy, a query which is close to a cached one but asks for something else ("read a csv file" and "write a
+csv file") gets the cached result if their cosine similarity reaches the threshold. Check the threshold for the model
+with the report of this module before enabling the cache:
+    python semantic_cache.py --model-path python_model/ --pairs pairs.jsonl
+"""
+
+# Pairs of queries and whether they ask for the same code, used when no pairs file is given
+DEFAULT_PAIRS = [
+    ("create a dataframe", "make a pandas dataframe", True),
+    ("read a json file", "load json from a file", True),
+    ("sort a list of dictionaries by a key", "order a list of dicts by one of their keys", True),
+    ("remove duplicates from a list", "deduplicate the elements of a list", True),
+    ("convert a string to lowercase", "make a string lower case", True),
+    ("download a file from a url", "fetch a file over http and save it", True),
+    ("check if a file exists", "test whether a path is an existing file", True),
+    ("split a string by whitespace", "break a string into words", True),
+    ("read a csv file", "write a csv file", False),
+    ("sort a list ascending", "sort a list descending", False),
+    ("convert a string to lowercase", "convert a string to uppercase", False),
+    ("open a file for reading", "open a file for writing", False),
+    ("add an element to a list", "remove an element from a list", False),
+    ("encode a string as base64", "decode a base64 string", False),
+    ("start a thread", "stop a thread", False),
+    ("compress a directory to a zip file", "extract a zip file to a directory", False),
+]
+
+
+class SemanticResultCache:
+    def __init__(self, dim: int, max_size: int = 1024, threshold: float = 0.95, ttl_seconds: float = None):
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError("Cosine threshold must be in (0, 1], got {}".format(threshold))
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Similarity of the cached query for every hit, to tune the threshold
+        self._hit_similarity = 0.0
+        # Slot i holds vectors[i], the k and context it was searched with, its results, creation and last use time
+        self._vectors = np.zeros((max_size, dim), dtype=np.float32)
+        self._keys: List[Optional[Tuple[int, Hashable]]] = [None] * max_size
+        self._results: List[Optional[list]] = [None] * max_size
+        self._created = np.zeros(max_size, dtype=np.float64)
+        self._last_used = np.full(max_size, -np.inf)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(key is not None for key in self._keys)
+
+    @staticmethod
+    def _unit(query_vec: np.ndarray) -> np.ndarray:
+        query_vec = np.asarray(query_vec, dtype=np.float32).ravel()
+        return query_vec / max(float(np.linalg.norm(query_vec)), 1e-12)
+
+    def _usable(self, slot: int, k: int, context: Hashable, now: float) -> bool:
+        key = self._keys[slot]
+        if key is None or key[0] < k or key[1] != context:
+            return False
+        return self.ttl_seconds is None or now - self._created[slot] <= self.ttl_seconds
+
+    def get(self, query_vec: np.ndarray, k: int, context: Hashable = None) -> Optional[list]:
+        query_vec = self._unit(query_vec)
+        now = time.time()
+        with self._lock:
+            similarities = self._vectors @ query_vec
+            # Slots are tried from the most similar one until one is usable or the threshold is missed
+            for slot in np.argsort(-similarities).tolist():
+                if similarities[slot] < self.threshold:
+                    break
+                if self._usable(slot, k, context, now):
+                    self._last_used[slot] = now
+                    self.hits += 1
+                    self._hit_similarity += float(similarities[slot])
+                    return self._results[slot][:k]
+            self.misses += 1
+            return None
+
+    def put(self, query_vec: np.ndarray, k: int, context: Hashable, results: list):
+        query_vec = self._unit(query_vec)
+        now = time.time()
+        with self._lock:
+            # An empty slot has never been used, so the least recently used slot is taken first
+            slot = int(np.argmin(self._last_used))
+            if self._keys[slot] is not None:
+                self.evictions += 1
+            self._vectors[slot] = query_vec
+            self._keys[slot] = (k, context)
+            self._results[slot] = results
+            self._created[slot] = now
+            self._last_used[slot] = now
+
+    def clear(self):
+        with self._lock:
+            self._vectors[:] = 0
+            self._keys = [None] * self.max_size
+            self._results = [None] * self.max_size
+            self._last_used[:] = -np.inf
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "mean_hit_similarity": self._hit_similarity / self.hits if self.hits > 0 else 0.0,
+        }
+
+
+def threshold_report(similarities: np.ndarray, paraphrase: np.ndarray, thresholds: List[float]) -> List[Dict]:
+    # Share of paraphrase pairs which would hit the cache and share of other pairs which would get a wrong result
+    similarities, paraphrase = np.asarray(similarities), np.asarray(paraphrase, dtype=bool)
+    return [
+        {
+            "threshold": threshold,
+            "paraphrase_hit_rate": float((similarities[paraphrase] >= threshold).mean()) if paraphrase.any() else 0.0,
+            "false_hit_rate": float((similarities[~paraphrase] >= threshold).mean()) if (~paraphrase).any() else 0.0,
+        }
+        for threshold in thresholds
+    ]
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from transformers import RobertaModel, RobertaTokenizerFast
+
+    from codebert_model import Model, QueryEncoder
+
+    parser = argparse.ArgumentParser(description="Hit and false hit rates of the semantic cache by cosine threshold")
+    parser.add_argument("--model-path", default="python_model/")
+    parser.add_argument("--tokenizer", default="microsoft/codebert-base")
+    parser.add_argument("--pairs", default=None, help="jsonl with query, other and paraphrase, default: built-in pairs")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.85, 0.9, 0.93, 0.95, 0.97, 0.99])
+    args = parser.parse_args()
+
+    pairs = DEFAULT_PAIRS
+    if args.pairs is not None:
+        with open(args.pairs) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        pairs = [(js["query"], js["other"], js["paraphrase"]) for js in records]
+    encoder = QueryEncoder(
+        RobertaTokenizerFast.from_pretrained(args.tokenizer),
+        Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=args.model_path)),
+    )
+    first = encoder.encode([query for query, _, _ in pairs])
+    second = encoder.encode([other for _, other, _ in pairs])
+    first /= np.maximum(np.linalg.norm(first, axis=1, keepdims=True), 1e-12)
+    second /= np.maximum(np.linalg.norm(second, axis=1, keepdims=True), 1e-12)
+    pair_similarities = (first * second).sum(axis=1)
+    for (query, other, is_paraphrase), similarity in zip(pairs, pair_similarities):
+        print("{:.4f} {:>5} {} | {}".format(similarity, "same" if is_paraphrase else "other", query, other))
+    for row in threshold_report(pair_similarities, [is_paraphrase for _, _, is_paraphrase in pairs], args.thresholds):
+        print(row)
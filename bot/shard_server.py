@@ -0,0 +1,347 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+from transformers import RobertaTokenizerFast, RobertaModel
+
+from code_search import CodeSearch
+from codebert_model import Model, QueryEncoder
+from embedding_store import EmbeddingStore, EmbeddingStoreWriter, model_fingerprint
+from query_cache import QueryEmbeddingCache
+from record_store import RecordStore
+from vector_search import block_scores, top_k_rows
+
+"""
+Scatter-gather code search over several processes. split_shards writes every contiguous row range of the embedding
+store and of the corpus to its own store and jsonl file, with a manifest which records where the rows belong in the
+full store. Every ShardServer only opens the files of its shard and answers with its local top-k, so no host needs the
+whole corpus. The ShardCoordinator sends the query embeddings to all shards at once and merges their answers into the
+global top-k. A shard which fails or times out is left out of the merged result instead of failing the whole request.
+
+Messages are a struct header with the lengths of a json header and of a binary payload, followed by both.
+"""
+
+logger = logging.getLogger(__name__)
+
+_FRAME_FORMAT = "<II"
+_FRAME_SIZE = struct.calcsize(_FRAME_FORMAT)
+
+
+def _recv_exactly(sock: socket.socket, n_bytes: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < n_bytes:
+        chunk = sock.recv(n_bytes - len(buffer))
+        if not chunk:
+            raise ConnectionError("Connection closed after {} of {} bytes".format(len(buffer), n_bytes))
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b""):
+    header_bytes = json.dumps(header).encode("UTF-8")
+    sock.sendall(struct.pack(_FRAME_FORMAT, len(header_bytes), len(payload)) + header_bytes + payload)
+
+
+def recv_message(sock: socket.socket) -> Tuple[dict, bytes]:
+    header_size, payload_size = struct.unpack(_FRAME_FORMAT, _recv_exactly(sock, _FRAME_SIZE))
+    header = json.loads(_recv_exactly(sock, header_size).decode("UTF-8"))
+    return header, _recv_exactly(sock, payload_size)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class _ShardRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection may carry several requests, it is served until the coordinator closes it
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                response = self.server.shard.handle(header, payload)
+            except Exception as e:
+                logger.exception("Shard request failed")
+                response = {"error": str(e)}
+            send_message(self.request, response)
+
+
+class ShardServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], shard: "Shard"):
+        self.shard = shard
+        super().__init__(address, _ShardRequestHandler)
+
+
+def split_shards(
+    store_path: str, corpus_path: str, output_dir: str, n_shards: int, block_size: int = 65536
+) -> List[str]:
+    # Writes shard-i.store, shard-i.jsonl and the manifest shard-i.json for every shard, returns the manifest paths.
+    # Only the three files of its shard have to be copied to a shard host.
+    embedding_store = EmbeddingStore(store_path)
+    records = RecordStore(corpus_path)
+    if len(records) != len(embedding_store):
+        raise ValueError(
+            "Embedding store {} has {} vectors but corpus {} has {} records".format(
+                store_path, len(embedding_store), corpus_path, len(records)
+            )
+        )
+    os.makedirs(output_dir, exist_ok=True)
+    bounds = np.linspace(0, len(embedding_store), n_shards + 1).astype(np.int64).tolist()
+    manifest_paths = []
+    for shard, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        name = "shard-{}".format(shard)
+        with EmbeddingStoreWriter(
+            os.path.join(output_dir, name + ".store"),
+            embedding_store.dim,
+            embedding_store.fingerprint,
+            dtype=embedding_store.header.dtype,
+        ) as writer:
+            for block_start in range(start, end, block_size):
+                writer.append(embedding_store.vectors[block_start:min(end, block_start + block_size)])
+            # Rows are copied as they are, the flag of a normalized store is only set for the header written on close
+            writer.header.normalized = embedding_store.normalized
+
+        # The records of a shard are one byte range of the corpus
+        corpus_tmp_path = "{}.{}.tmp".format(os.path.join(output_dir, name + ".jsonl"), os.getpid())
+        with open(corpus_path, "rb") as source, open(corpus_tmp_path, "wb") as target:
+            source.seek(int(records.offsets[start]))
+            remaining = int(records.offsets[end]) - int(records.offsets[start])
+            while remaining > 0:
+                block = source.read(min(remaining, 1 << 20))
+                target.write(block)
+                remaining -= len(block)
+        os.replace(corpus_tmp_path, os.path.join(output_dir, name + ".jsonl"))
+
+        # The manifest is written last, a shard with a manifest is complete
+        manifest = {
+            "start": start,
+            "end": end,
+            "n_rows": len(embedding_store),
+            "store": name + ".store",
+            "corpus": name + ".jsonl",
+        }
+        manifest_path = os.path.join(output_dir, name + ".json")
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        manifest_paths.append(manifest_path)
+    return manifest_paths
+
+
+class Shard:
+    """
+    Rows start to end of the full embedding store together with their records, read from the files written by
+    split_shards. Result ids are rows of the full store.
+    """
+
+    def __init__(self, manifest_path: str):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        # The files of a shard are named relative to its manifest
+        directory = os.path.dirname(manifest_path)
+        store_path = os.path.join(directory, manifest["store"])
+        corpus_path = os.path.join(directory, manifest["corpus"])
+        self.embedding_store = EmbeddingStore(store_path)
+        self.records = RecordStore(corpus_path)
+        self.start = manifest["start"]
+        self.end = manifest["end"]
+        self.n_rows = manifest["n_rows"]
+        if not len(self.records) == len(self.embedding_store) == self.end - self.start:
+            raise ValueError(
+                "Shard {} is rows {} to {} but store {} has {} vectors and corpus {} has {} records".format(
+                    manifest_path, self.start, self.end, store_path, len(self.embedding_store), corpus_path,
+                    len(self.records)
+                )
+            )
+        self.vectors = self.embedding_store.vectors
+
+    def search(self, query_vecs: np.ndarray, k: int) -> List[List[Tuple[int, float, str]]]:
+        query_vecs = self.embedding_store.prepare_queries(query_vecs)
+        indices, scores = top_k_rows(block_scores(query_vecs, self.vectors), k)
+        return [
+            [
+                (self.start + int(index), float(score), self.records[int(index)]["code"])
+                for index, score in zip(row_indices, row_scores)
+            ]
+            for row_indices, row_scores in zip(indices, scores)
+        ]
+
+    def handle(self, header: dict, payload: bytes) -> dict:
+        if header.get("type") == "info":
+            return {
+                "start": self.start,
+                "end": self.end,
+                "n_rows": self.n_rows,
+                "dim": self.embedding_store.dim,
+                "fingerprint": self.embedding_store.fingerprint,
+            }
+        query_vecs = np.frombuffer(payload, dtype=np.float32).reshape(header["n_queries"], header["dim"])
+        if query_vecs.shape[1] != self.embedding_store.dim:
+            raise ValueError("Queries have dimension {}, the shard has {}".format(
+                query_vecs.shape[1], self.embedding_store.dim
+            ))
+        return {"results": self.search(query_vecs, header["k"])}
+
+
+class ShardCoordinator:
+    """
+    Fans a batch of query embeddings out to all shards and merges their top-k. Every call opens one connection per
+    shard, so a restarted shard is picked up again by the next request.
+    """
+
+    def __init__(self, addresses: List[str], timeout: float = 5.0):
+        self.addresses = addresses
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=len(addresses))
+        # Misconfigured shards found by validate, they are never queried
+        self.excluded = set()
+
+    def _request(self, address: str, header: dict, payload: bytes = b"") -> dict:
+        with socket.create_connection(parse_address(address), timeout=self.timeout) as sock:
+            send_message(sock, header, payload)
+            response, _ = recv_message(sock)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def info(self) -> List[Optional[dict]]:
+        futures = [self.executor.submit(self._request, address, {"type": "info"}) for address in self.addresses]
+        infos = []
+        for address, future in zip(self.addresses, futures):
+            try:
+                infos.append(future.result())
+            except Exception as e:
+                logger.warning("Shard %s is unavailable: %s", address, e)
+                infos.append(None)
+        return infos
+
+    def validate(self, fingerprint: str) -> List[str]:
+        # Excludes shards whose embeddings come from another model or whose row ranges overlap, returns the problems
+        problems = []
+        ranges = []
+        infos = self.info()
+        for address, info in zip(self.addresses, infos):
+            if info is None:
+                # An unavailable shard is only degraded, it is used again once it answers
+                continue
+            if info["fingerprint"] != fingerprint:
+                problems.append("Shard {} was embedded with another model".format(address))
+                self.excluded.add(address)
+            else:
+                ranges.append((info["start"], info["end"], address))
+        ranges.sort()
+        gaps = []
+        expected_start = 0
+        for start, end, address in ranges:
+            if start < expected_start:
+                problems.append("Rows {} to {} of shard {} overlap another shard".format(start, end, address))
+                self.excluded.add(address)
+                continue
+            if start > expected_start:
+                gaps.append((expected_start, start))
+            expected_start = end
+        store_sizes = {info["n_rows"] for info in infos if info is not None}
+        if len(store_sizes) > 1:
+            problems.append("Shards serve stores of different sizes {}".format(sorted(store_sizes)))
+        if expected_start < max(store_sizes, default=0):
+            gaps.append((expected_start, max(store_sizes)))
+        # The rows of an unavailable shard are unknown, gaps are only reported when every shard answered
+        if all(info is not None for info in infos):
+            problems.extend("Rows {} to {} are not served by any shard".format(start, end) for start, end in gaps)
+        for problem in problems:
+            logger.error(problem)
+        return problems
+
+    def search(self, query_vecs: np.ndarray, k: int) -> Tuple[List[List[Tuple[int, float, str]]], List[str]]:
+        # Returns the merged top-k of every query and the addresses of the shards which did not answer
+        query_vecs = np.ascontiguousarray(query_vecs, dtype=np.float32)
+        header = {"type": "search", "k": k, "n_queries": len(query_vecs), "dim": query_vecs.shape[1]}
+        payload = query_vecs.tobytes()
+        addresses = [address for address in self.addresses if address not in self.excluded]
+        futures = [self.executor.submit(self._request, address, header, payload) for address in addresses]
+
+        merged = [[] for _ in range(len(query_vecs))]
+        # Excluded shards are reported as failed, their rows are missing as well
+        failed_shards = [address for address in self.addresses if address in self.excluded]
+        for address, future in zip(addresses, futures):
+            try:
+                shard_results = future.result()["results"]
+            except Exception as e:
+                logger.warning("Shard %s failed, its rows are missing from the results: %s", address, e)
+                failed_shards.append(address)
+                continue
+            for query_results, results in zip(merged, shard_results):
+                query_results.extend((int(index), float(score), code) for index, score, code in results)
+        # Every shard sorted its own results, the merged lists hold at most n_shards * k entries
+        return [sorted(results, key=lambda result: -result[1])[:k] for results in merged], failed_shards
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ScatterGatherCodeSearch(CodeSearch):
+    def __init__(
+        self,
+        shard_addresses: List[str],
+        model_path: str = "python_model/",
+        timeout: float = 5.0,
+        query_cache_size: int = 1024,
+    ):
+        self.tokenizer = RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+        self.model = Model(RobertaModel.from_pretrained(pretrained_model_name_or_path=model_path))
+        self.model_fingerprint = model_fingerprint(model_path)
+        self.query_cache = None
+        if query_cache_size > 0:
+            self.query_cache = QueryEmbeddingCache(self.model_fingerprint, max_size=query_cache_size)
+        self.query_encoder = QueryEncoder(self.tokenizer, self.model, query_cache=self.query_cache)
+        self.coordinator = ShardCoordinator(shard_addresses, timeout=timeout)
+        # Shards of another model or with overlapping rows would return wrong results, they are left out
+        self.shard_problems = self.coordinator.validate(self.model_fingerprint)
+        # Failed shards of the last request, so callers can tell that the results are incomplete
+        self.failed_shards = []
+
+    def find_code_for_queries(self, queries: List[str], k: int = 1) -> List[List[Tuple[int, float, str]]]:
+        results, self.failed_shards = self.coordinator.search(self.query_encoder.encode(queries), k)
+        return results
+
+    def find_code_for_query_topk(self, query: str, k: int) -> List[Tuple[int, float, str]]:
+        return self.find_code_for_queries([query], k=k)[0]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Split an embedding store into shards and serve them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    split_parser = subparsers.add_parser("split", help="Write the store and corpus of every shard to a directory")
+    split_parser.add_argument("store_path")
+    split_parser.add_argument("corpus_path")
+    split_parser.add_argument("output_dir")
+    split_parser.add_argument("--n-shards", type=int, required=True)
+    serve_parser = subparsers.add_parser("serve", help="Serve one shard written by split")
+    serve_parser.add_argument("manifest_path", help="shard-i.json of the shard, its files are next to it")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "split":
+        for path in split_shards(args.store_path, args.corpus_path, args.output_dir, args.n_shards):
+            print("Wrote {}".format(path))
+    else:
+        shard = Shard(args.manifest_path)
+        with ShardServer((args.host, args.port), shard) as server:
+            logger.info("Serving rows %d to %d on %s:%d", shard.start, shard.end, args.host, args.port)
+            server.serve_forever()
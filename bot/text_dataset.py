@@ -1,8 +1,11 @@
 import json
 import os
 import logging
+import random
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 
 """
 Dataset used for the training and evaluation process
@@ -49,18 +52,130 @@ def convert_examples_to_features(js, tokenizer):
     return InputFeatures(code_tokens, code_ids, nl_tokens, nl_ids, js['url'])
 
 
+def convert_examples_to_features_batched(js_list, tokenizer):
+    # Same features as convert_examples_to_features, but a fast tokenizer encodes the whole list in one call and
+    # truncates while encoding. Slow tokenizers fall back to the per example conversion.
+    if not getattr(tokenizer, 'is_fast', False):
+        return [convert_examples_to_features(js, tokenizer) for js in js_list]
+    if len(js_list) == 0:
+        return []
+
+    code_length = 256
+    nl_length = 128
+
+    code_batch = tokenizer(
+        [' '.join(js['code_tokens']) for js in js_list],
+        truncation=True, max_length=code_length, padding='max_length'
+    )
+    nl_batch = tokenizer(
+        [' '.join(js['docstring_tokens']) for js in js_list],
+        truncation=True, max_length=nl_length, padding='max_length'
+    )
+    features = []
+    for i, js in enumerate(js_list):
+        code_tokens = code_batch.tokens(i)[:sum(code_batch['attention_mask'][i])]
+        nl_tokens = nl_batch.tokens(i)[:sum(nl_batch['attention_mask'][i])]
+        features.append(InputFeatures(code_tokens, code_batch['input_ids'][i], nl_tokens, nl_batch['input_ids'][i], js['url']))
+    return features
+
+
+def _feature_cache_meta(tokenizer, file_path):
+    return {
+        "source_size": os.path.getsize(file_path),
+        "source_mtime_ns": os.stat(file_path).st_mtime_ns,
+        "tokenizer": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer),
+    }
+
+
+def _json_batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            batch.append(json.loads(line))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def build_feature_cache(tokenizer, file_path, cache_dir, batch_size=1024):
+    """
+    Tokenizes a jsonl file once and stores the ids as compact .npy arrays: code_ids (n, 256) and nl_ids (n, 128) as
+    uint16 (the vocabulary has less than 65536 entries) and the number of real tokens in code_lengths and nl_lengths.
+    """
+    if len(tokenizer) > np.iinfo(np.uint16).max:
+        raise ValueError("Vocabulary of {} tokens does not fit into uint16".format(len(tokenizer)))
+    with open(file_path) as f:
+        n_records = sum(1 for line in f if line.strip())
+    if n_records == 0:
+        raise ValueError("{} does not contain any records".format(file_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {}
+    with open(file_path) as f:
+        i = 0
+        for js_batch in _json_batches(f, batch_size):
+            examples = convert_examples_to_features_batched(js_batch, tokenizer)
+            if i == 0:
+                # Arrays are written through a memory map, the features are never held in memory together
+                arrays["code_ids"] = np.lib.format.open_memmap(
+                    os.path.join(cache_dir, "code_ids.npy"), mode="w+", dtype=np.uint16,
+                    shape=(n_records, len(examples[0].code_ids))
+                )
+                arrays["nl_ids"] = np.lib.format.open_memmap(
+                    os.path.join(cache_dir, "nl_ids.npy"), mode="w+", dtype=np.uint16,
+                    shape=(n_records, len(examples[0].nl_ids))
+                )
+                arrays["code_lengths"] = np.zeros(n_records, dtype=np.uint16)
+                arrays["nl_lengths"] = np.zeros(n_records, dtype=np.uint16)
+            end = i + len(examples)
+            arrays["code_ids"][i:end] = [example.code_ids for example in examples]
+            arrays["nl_ids"][i:end] = [example.nl_ids for example in examples]
+            arrays["code_lengths"][i:end] = [len(example.code_tokens) for example in examples]
+            arrays["nl_lengths"][i:end] = [len(example.nl_tokens) for example in examples]
+            i = end
+    for name, array in arrays.items():
+        if isinstance(array, np.memmap):
+            array.flush()
+        else:
+            np.save(os.path.join(cache_dir, name + ".npy"), array)
+    # The meta file is written last and marks the cache as complete
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(_feature_cache_meta(tokenizer, file_path), f)
+
+
+def feature_cache_is_valid(tokenizer, file_path, cache_dir):
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        return json.load(f) == _feature_cache_meta(tokenizer, file_path)
+
+
 class TextDataset(Dataset):
-    def __init__(self, tokenizer, file_path):
+    def __init__(self, tokenizer, file_path, cache_dir=None):
         self.examples = []
         self.data = []
+        self.cache = None
+        if cache_dir is not None:
+            # Pre-tokenized mode: the id arrays are memory mapped, nothing is parsed or tokenized
+            if not feature_cache_is_valid(tokenizer, file_path, cache_dir):
+                build_feature_cache(tokenizer, file_path, cache_dir)
+            self.cache = {
+                name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r")
+                for name in ["code_ids", "nl_ids", "code_lengths", "nl_lengths"]
+            }
+            return
+
         with open(file_path) as f:
             for line in f:
                 line = line.strip()
                 js = json.loads(line)
                 self.data.append(js)
 
-        for js in self.data:
-            self.examples.append(convert_examples_to_features(js, tokenizer))
+        self.examples = convert_examples_to_features_batched(self.data, tokenizer)
 
         logger = logging.getLogger()
         logging.basicConfig(level=logging.DEBUG)
@@ -75,7 +190,129 @@ class TextDataset(Dataset):
                 logger.info("nl_ids: {}".format(' '.join(map(str, example.nl_ids))))
 
     def __len__(self):
+        if self.cache is not None:
+            return len(self.cache["code_ids"])
         return len(self.examples)
 
     def __getitem__(self, i):
+        if self.cache is not None:
+            return (
+                torch.from_numpy(self.cache["code_ids"][i].astype(np.int64)),
+                torch.from_numpy(self.cache["nl_ids"][i].astype(np.int64)),
+            )
         return (torch.tensor(self.examples[i].code_ids), torch.tensor(self.examples[i].nl_ids))
+
+    def code_lengths(self):
+        if self.cache is not None:
+            return self.cache["code_lengths"].tolist()
+        return [len(example.code_tokens) for example in self.examples]
+
+
+class StreamingTextDataset(IterableDataset):
+    """
+    Streams a jsonl file and tokenizes the records on the fly, so memory does not grow with the size of the corpus.
+    Inside a DataLoader with several workers, worker w only parses and tokenizes the lines i with
+    i % num_workers == w, so every record is yielded exactly once.
+    With return_index the line number is yielded as well, which allows to restore the corpus order.
+    A shuffle buffer gives an approximate random order for training.
+    """
+
+    def __init__(self, tokenizer, file_path, return_index=False, shuffle_buffer_size=0, seed=None):
+        self.tokenizer = tokenizer
+        self.file_path = file_path
+        self.return_index = return_index
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+
+    def _records(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        with open(self.file_path) as f:
+            index = 0
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if index % num_workers == worker_id:
+                    example = convert_examples_to_features(json.loads(line), self.tokenizer)
+                    item = (torch.tensor(example.code_ids), torch.tensor(example.nl_ids))
+                    yield (index,) + item if self.return_index else item
+                index += 1
+
+    def __iter__(self):
+        if self.shuffle_buffer_size <= 1:
+            return self._records()
+        return self._shuffled(self._records())
+
+    def _shuffled(self, items):
+        worker_info = get_worker_info()
+        rng = random.Random(None if self.seed is None else self.seed + (0 if worker_info is None else worker_info.id))
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yields batches of indices with similar lengths, so that collate_pad_to_longest only has to pad little.
+    Indices are shuffled, split into buckets of bucket_size, sorted by length inside a bucket and cut into batches.
+    The order of the batches is shuffled as well.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=None, shuffle=True, drop_last=False, seed=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size if bucket_size is not None else batch_size * 100
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.random = random.Random(seed)
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            self.random.shuffle(indices)
+        else:
+            # Without shuffling the whole dataset is a single bucket
+            indices.sort(key=lambda i: self.lengths[i])
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            self.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            n_batches = 0
+            for start in range(0, len(self.lengths), self.bucket_size):
+                n_batches += min(self.bucket_size, len(self.lengths) - start) // self.batch_size
+            return n_batches
+        return sum(
+            (min(self.bucket_size, len(self.lengths) - start) + self.batch_size - 1) // self.batch_size
+            for start in range(0, len(self.lengths), self.bucket_size)
+        )
+
+
+def collate_pad_to_longest(batch, pad_token_id=1):
+    # Pads every field of the batch to its longest member only. Inputs which are already padded to a fixed length
+    # are cut back to their non padding tokens first. Fields which are no sequences, like the line numbers of
+    # StreamingTextDataset(return_index=True), are stacked as they are.
+    collated = []
+    for field in zip(*batch):
+        if not (torch.is_tensor(field[0]) and field[0].dim() > 0):
+            collated.append(torch.tensor(field) if not torch.is_tensor(field[0]) else torch.stack(field))
+            continue
+        sequences = [sequence[:int(sequence.ne(pad_token_id).sum())] for sequence in field]
+        collated.append(pad_sequence(sequences, batch_first=True, padding_value=pad_token_id))
+    return tuple(collated)
@@ -0,0 +1,44 @@
+import argparse
+import time
+
+from transformers import RobertaTokenizer, RobertaTokenizerFast
+
+from record_store import RecordStore
+from text_dataset import convert_examples_to_features, convert_examples_to_features_batched
+
+"""
+Compares the per example conversion with the slow tokenizer against the batched conversion with the fast tokenizer.
+Checks that both produce the same ids and reports their throughput.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("corpus_path")
+    parser.add_argument("--n-records", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    corpus = RecordStore(args.corpus_path)
+    records = [corpus[i] for i in range(min(args.n_records, len(corpus)))]
+    slow_tokenizer = RobertaTokenizer.from_pretrained("microsoft/codebert-base")
+    fast_tokenizer = RobertaTokenizerFast.from_pretrained("microsoft/codebert-base")
+
+    start_time = time.perf_counter()
+    slow_features = [convert_examples_to_features(js, slow_tokenizer) for js in records]
+    slow_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    fast_features = []
+    for start in range(0, len(records), args.batch_size):
+        fast_features.extend(convert_examples_to_features_batched(records[start:start + args.batch_size], fast_tokenizer))
+    fast_seconds = time.perf_counter() - start_time
+
+    mismatches = sum(
+        slow.code_ids != fast.code_ids or slow.nl_ids != fast.nl_ids
+        or len(slow.code_tokens) != len(fast.code_tokens) or len(slow.nl_tokens) != len(fast.nl_tokens)
+        for slow, fast in zip(slow_features, fast_features)
+    )
+    print("Records:             {}".format(len(records)))
+    print("Mismatching records: {}".format(mismatches))
+    print("Per example (slow):  {:.2f}s, {:.0f} records/s".format(slow_seconds, len(records) / slow_seconds))
+    print("Batched (fast):      {:.2f}s, {:.0f} records/s".format(fast_seconds, len(records) / fast_seconds))
@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import numpy as np
+
+"""
+Helpers for ranking similarity scores of a query against a set of corpus vectors
+"""
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Partial selection of the k highest scores, only these k are sorted afterwards
+    scores = np.asarray(scores)
+    k = max(0, min(k, len(scores)))
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    order = np.argsort(-scores[candidates], kind="stable")
+    indices = candidates[order]
+    return indices, scores[indices]
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # top_k for every row of a (queries, corpus) score matrix
+    scores = np.asarray(scores)
+    k = max(0, min(k, scores.shape[1]))
+    if k == 0:
+        return np.empty((len(scores), 0), dtype=np.int64), np.empty((len(scores), 0), dtype=scores.dtype)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+
+def block_scores(query_vecs: np.ndarray, vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    # float32 vectors are scored in one product, narrower rows are upcast one block at a time since numpy has no
+    # BLAS kernels for float16 and would otherwise copy the whole matrix
+    query_vecs = np.asarray(query_vecs, dtype=np.float32)
+    if vectors.dtype == np.float32:
+        return query_vecs @ vectors.T
+    scores = np.empty((len(query_vecs), len(vectors)), dtype=np.float32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        scores[:, start:start + block_size] = query_vecs @ block.T
+    return scores
+
+
+def top_k_of_rows(
+    query_vecs: np.ndarray, vectors: np.ndarray, rows: np.ndarray, k: int, block_size: int = 65536,
+    full_scan_share: float = 0.5
+) -> Tuple[np.ndarray, np.ndarray]:
+    # top_k_rows over the sorted subset rows of the corpus, returned as corpus rows. At most block_size rows are
+    # gathered from the mapped vectors at a time and a running top-k is kept across the blocks. A subset which holds
+    # most of the corpus is scored in place by the full scan instead, with the other rows masked out.
+    query_vecs = np.asarray(query_vecs, dtype=np.float32)
+    k = max(0, min(k, len(rows)))
+    if len(rows) >= full_scan_share * len(vectors):
+        scores = block_scores(query_vecs, vectors, block_size=block_size)
+        excluded = np.ones(len(vectors), dtype=bool)
+        excluded[rows] = False
+        scores[:, excluded] = -np.inf
+        return top_k_rows(scores, k)
+    indices = np.empty((len(query_vecs), 0), dtype=np.int64)
+    scores = np.empty((len(query_vecs), 0), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        block_indices, block_top_scores = top_k_rows(block_scores(query_vecs, vectors[block_rows]), k)
+        # Candidates of earlier blocks come first, so ties keep the lower row like the full scan does
+        indices = np.concatenate([indices, block_rows[block_indices]], axis=1)
+        positions, scores = top_k_rows(np.concatenate([scores, block_top_scores], axis=1), k)
+        indices = np.take_along_axis(indices, positions, axis=1)
+    return indices, scores
+
+
+class ShardedScorer:
+    """
+    Scores queries against row shards of the corpus matrix concurrently on a thread pool, numpy releases the GIL
+    during the matrix products. Every shard keeps its own top-k which are merged into the final top-k.
+    """
+
+    def __init__(self, vectors: np.ndarray, n_shards: int, max_workers: int = None):
+        self.vectors = vectors
+        bounds = np.linspace(0, len(vectors), n_shards + 1).astype(np.int64)
+        self.shards = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else len(self.shards))
+
+    def _score_shard(self, query_vecs: np.ndarray, start: int, end: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        indices, scores = top_k_rows(block_scores(query_vecs, self.vectors[start:end]), k)
+        return indices + start, scores
+
+    def top_k(self, query_vecs: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if len(self.shards) == 0:
+            return top_k_rows(np.empty((len(query_vecs), 0), dtype=np.float32), k)
+        futures = [self.executor.submit(self._score_shard, query_vecs, start, end, k) for start, end in self.shards]
+        shard_results = [future.result() for future in futures]
+        indices = np.concatenate([result[0] for result in shard_results], axis=1)
+        scores = np.concatenate([result[1] for result in shard_results], axis=1)
+        # The merged candidates hold at most n_shards * k entries per query
+        positions, scores = top_k_rows(scores, k)
+        return np.take_along_axis(indices, positions, axis=1), scores
+
+    def close(self):
+        self.executor.shutdown()